@@ -0,0 +1,94 @@
+import logging, sys, time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from process_campaign.generate_sql_query import widen_metrics
+
+# compares widening the long metrics report with set_index/unstack against
+# the previous pivot_table(aggfunc = lambda x: x) and per-period xs slices,
+# on a synthetic report; no database is needed
+
+
+def pivot_table_widen(data, id_cols, metrics, promo_periods):
+    # the previous reshape of compute_and_output_metrics
+    data = data[id_cols + ['promo_period'] + metrics]
+    pivot = data.pivot_table(index = id_cols,
+        columns = 'promo_period', aggfunc = lambda x: x)
+    return pd.concat([pivot.xs(i, axis = 1, level = 'promo_period')[metrics]
+        .rename(columns = lambda x: '{}\n{}'.format(x, i))
+        for i in promo_periods], axis = 1)
+
+
+def synthetic_report(n_targets, n_metrics, promo_periods, seed = 0):
+    # counts for even metrics and formatted rates for odd ones, one row per
+    # target, responder flag and period as returned by the metrics query
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([
+        ['target_{:04d}'.format(i) for i in range(n_targets)],
+        [True, False], promo_periods],
+        names = ['target_name', 'responder', 'promo_period'])
+    data = pd.DataFrame(index = index).reset_index()
+    metrics = []
+    for i in range(n_metrics):
+        name = 'metric_{:02d}'.format(i)
+        values = rng.integers(0, 1000, len(data))
+        data[name] = (values if i % 2 == 0 else
+                      ['{:.2%}'.format(v / 1000) for v in values])
+        metrics.append(name)
+    return data, metrics
+
+
+def time_reshape(widen, data, metrics, promo_periods, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        wide = widen(data, ['target_name', 'responder'], metrics,
+                     promo_periods)
+        timings.append(time.perf_counter() - start)
+    return wide, sorted(timings)[len(timings) // 2]
+
+
+def main(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format = '{asctime} {levelname:8s} {message}',
+        datefmt = '%m-%d %H:%M:%S',
+        style = '{',
+        stream=sys.stdout)
+
+    promo_periods = ['promo_period', 'post_promo_period', 'long_term'][
+        :args.n_periods]
+    data, metrics = synthetic_report(args.n_targets, args.n_metrics,
+                                     promo_periods)
+    logging.info('Synthetic report with {:,} rows, {} targets and {} '
+                 'metrics over {} periods'.format(len(data), args.n_targets,
+                 args.n_metrics, len(promo_periods)))
+
+    results = []
+    for name, widen in [('pivot_table', pivot_table_widen),
+                        ('unstack', widen_metrics)]:
+        wide, seconds = time_reshape(widen, data, metrics, promo_periods,
+                                     args.repeat)
+        results.append(wide)
+        logging.info('{:12s} {:>8,} x {:<6,} {:8.3f}s median of {}'.format(
+            name, wide.shape[0], wide.shape[1], seconds, args.repeat))
+
+    before, after = results
+    if not before.astype(str).equals(after.astype(str)):
+        logging.error('Reshaped reports differ')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Benchmark widening the metrics report against '
+                            'the previous pivot_table reshape.')
+    parser.add_argument('--n_targets', type = int, default = 500,
+        help = 'number of target names in the synthetic report')
+    parser.add_argument('--n_metrics', type = int, default = 40,
+        help = 'number of metric columns in the synthetic report')
+    parser.add_argument('--n_periods', type = int, default = 3,
+        choices = [1, 2, 3],
+        help = 'number of promo periods in the synthetic report')
+    parser.add_argument('--repeat', type = int, default = 3,
+        help = 'number of runs of each reshape')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+import logging, re, sys, time
+from argparse import ArgumentParser
+from pathlib import Path
+from process_campaign.upload_redshift import (extract_campaign_info,
+    create_redshift_engine)
+from process_campaign.generate_sql_query import build_query
+
+# compares the aggregate step of the metrics query looking up the responder
+# flag once per user against the previous self-join of individual_metrics
+
+
+def self_join_query(query, info):
+    # rewrite the generated query into its previous self-join form
+    query = re.sub(r",\s*responders AS \(.*?WHERE promo_period = "
+                   r"'promo_period'\)", '', query, flags = re.S)
+    return (query
+        .replace("""INNER JOIN responders r
+        ON a.user_id = r.user_id""", """INNER JOIN individual_metrics r
+        ON a.user_id = r.user_id
+        AND r.promo_period = 'promo_period'""")
+        .replace('r.responder AS responder',
+                 'r.{} AS responder'.format(info.responder_action)))
+
+
+def joined_rows_query(query):
+    # rows feeding the GROUP BY of the final aggregate
+    ctes, aggregate = query.rsplit('SELECT a.promo_period', 1)
+    joins = (aggregate.split('FROM individual_metrics a', 1)[1]
+                      .split('GROUP BY', 1)[0])
+    return '{}SELECT COUNT(*) FROM individual_metrics a {}'.format(
+        ctes, joins)
+
+
+def time_query(connection, query, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_rows = len(connection.execute(query).fetchall())
+        timings.append(time.perf_counter() - start)
+    return n_rows, sorted(timings)[len(timings) // 2]
+
+
+def main(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format = '{asctime} {levelname:8s} {message}',
+        datefmt = '%m-%d %H:%M:%S',
+        style = '{',
+        stream=sys.stdout)
+
+    _, test_matrix, campaign_info = extract_campaign_info(args)
+    if campaign_info.responder_action == 1:
+        logging.info('Responder action is 1, so neither query joins for '
+                     'the responder flag')
+        return
+
+    after = build_query(campaign_info, test_matrix, bucketed = args.bucketed)
+    before = self_join_query(after, campaign_info)
+
+    engine = create_redshift_engine()
+    with engine.connect() as connection:
+        # cached results would hide the cost of the repeated runs
+        connection.execute('SET enable_result_cache_for_session TO off')
+        for name, query in [('self join', before),
+                            ('responders', after)]:
+            joined_rows = connection.execute(
+                joined_rows_query(query)).fetchone()[0]
+            n_rows, seconds = time_query(connection, query, args.repeat)
+            logging.info('{:12s} {:>12,} rows joined {:>6,} rows output '
+                         '{:8.2f}s median of {}'.format(name, joined_rows,
+                         n_rows, seconds, args.repeat))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Benchmark the responder lookup of the metrics '
+                            'query against the previous self join.')
+    parser.add_argument('--root_dir',
+        help = 'path to directory containing information on all campaigns',
+        default = str(Path(Path.home(),
+            'Google Drive File Stream', 'My Drive',
+            'Reformatted Prioritized Campaign Lists')))
+    parser.add_argument('campaign_dir',
+        help = 'name of directory for desired campaign')
+    parser.add_argument('--bucketed', action = 'store_true',
+        help = 'benchmark the bucketed form of the metrics query')
+    parser.add_argument('--repeat', type = int, default = 3,
+        help = 'number of runs of each query')
+    args = parser.parse_args()
+    main(args)
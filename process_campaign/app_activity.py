@@ -0,0 +1,113 @@
+import logging, sys
+from argparse import ArgumentParser
+import pandas as pd
+from process_campaign.upload_redshift import (create_redshift_engine,
+    grant_select)
+from process_campaign.daily_facts import FULL_REFRESH_START
+
+APP_ACTIVE_DAYS = 'analytics.user_app_active_days'
+
+
+def app_active_days_ddl():
+    # one row per user and UTC day with any iOS or Android event; the first
+    # event of the day is enough to test it against a period's end_date
+    return """CREATE TABLE IF NOT EXISTS {} (
+        internal_user_id BIGINT ENCODE AZ64,
+        active_date DATE ENCODE RAW,
+        first_seen TIMESTAMP ENCODE AZ64)
+    DISTKEY(internal_user_id)
+    SORTKEY(active_date, internal_user_id)""".format(APP_ACTIVE_DAYS)
+
+
+def app_active_days_query(refresh_from):
+    return """SELECT u.internal_user_id
+        , DATE(app_visits.client_timestamp) AS active_date
+        , min(app_visits.client_timestamp) AS first_seen
+    FROM (
+        SELECT external_user_id
+        , client_timestamp
+        FROM dw.app_track_events
+        WHERE client_timestamp >= '{refresh_from}'
+        UNION all
+        SELECT external_user_id
+        , client_timestamp
+        FROM dw.android_events
+        WHERE client_timestamp >= '{refresh_from}'
+    ) app_visits
+    INNER JOIN dw.users u
+        ON app_visits.external_user_id = u.external_id
+    WHERE u.internal_user_id IS NOT NULL
+    GROUP BY 1,2""".format(refresh_from = refresh_from)
+
+
+def app_active_days_watermark(engine):
+    # the last day in the index; events arrive in order of client time
+    # apart from the stragglers the lookback picks up
+    if not engine.has_table(APP_ACTIVE_DAYS.split('.')[1],
+                            schema = 'analytics'):
+        return None
+    active_date = pd.read_sql_query('SELECT max(active_date) AS active_date '
+        'FROM {}'.format(APP_ACTIVE_DAYS), engine).active_date.iloc[0]
+    return None if pd.isnull(active_date) else pd.Timestamp(active_date)
+
+
+def refresh_app_active_days(engine, usernames, lookback_days = 3,
+                            since = None):
+    watermark = app_active_days_watermark(engine)
+    if since is not None or watermark is None:
+        refresh_from = pd.Timestamp(since or FULL_REFRESH_START)
+    else:
+        refresh_from = watermark - pd.Timedelta(days = lookback_days)
+    refresh_from = refresh_from.strftime('%Y-%m-%d')
+
+    with engine.begin() as connection:
+        connection.execute(app_active_days_ddl())
+        deleted = connection.execute(
+            "DELETE FROM {} WHERE active_date >= '{}'".format(
+                APP_ACTIVE_DAYS, refresh_from)).rowcount
+        inserted = connection.execute('INSERT INTO {} {}'.format(
+            APP_ACTIVE_DAYS, app_active_days_query(refresh_from))).rowcount
+        connection.execute('ANALYZE {}'.format(APP_ACTIVE_DAYS))
+        grant_select(connection, APP_ACTIVE_DAYS, usernames)
+
+    logging.info('Table {} refreshed from {}: {} rows deleted and {} rows '
+                 'inserted'.format(APP_ACTIVE_DAYS, refresh_from, deleted,
+                                   inserted))
+
+
+def main(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format = '{asctime} {name:12s} {levelname:8s} {message}',
+        datefmt = '%m-%d %H:%M:%S',
+        style = '{',
+        stream=sys.stdout)
+
+    [logging.info('Input argument {} set to {}'.format(k, v))
+        for k,v in vars(args).items()]
+
+    if args.dry_run:
+        logging.info('DDL for {}:\n{}'.format(APP_ACTIVE_DAYS,
+                                             app_active_days_ddl()))
+        logging.info('Refresh query:\n{}'.format(
+            app_active_days_query(args.since or FULL_REFRESH_START)))
+        return
+    engine = create_redshift_engine()
+    usernames = ['production_read_only', 'analytics_team', 'prod_application']
+    refresh_app_active_days(engine, usernames,
+                            lookback_days = args.lookback_days,
+                            since = args.since)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Refresh the per-user index of days with app '
+                            'activity read by the used_the_app metric.')
+    parser.add_argument('--lookback_days', type = int, default = 3,
+        help = 'days before the last indexed day that are rebuilt')
+    parser.add_argument('--since', default = None,
+        help = 'rebuild every day from this date on instead of from the '
+               'last indexed day')
+    parser.add_argument('--dry_run', action = 'store_true',
+        help = 'print the table DDL and refresh query without running them')
+    args = parser.parse_args()
+    main(args)
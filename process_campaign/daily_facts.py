@@ -0,0 +1,320 @@
+import logging, sys
+from argparse import ArgumentParser
+import pandas as pd
+from process_campaign.upload_redshift import (create_redshift_engine,
+    grant_select)
+
+DAILY_FACTS = 'analytics.campaign_user_daily_facts'
+DAILY_FACTS_REFRESHES = 'analytics.campaign_user_daily_facts_refreshes'
+FULL_REFRESH_START = '2017-01-01'
+
+# rollup column -> type, encoding and how rows of several sources for the
+# same user and day are combined
+FACT_COLUMNS = [
+    ('normal_boxes', 'INT', 'AZ64', 'SUM'),
+    ('delivery_schedules', 'VARCHAR(256)', 'ZSTD', 'MAX'),
+    ('nth_deliveries', 'VARCHAR(256)', 'ZSTD', 'MAX'),
+    ('gov', 'DOUBLE PRECISION', 'ZSTD', 'SUM'),
+    ('dessert_boxes', 'INT', 'AZ64', 'SUM'),
+    ('activated', 'BOOLEAN', 'ZSTD', 'bool_or'),
+    ('reactivated', 'BOOLEAN', 'ZSTD', 'bool_or'),
+    ('canceled', 'BOOLEAN', 'ZSTD', 'bool_or'),
+    ('last_change_at', 'TIMESTAMP', 'AZ64', 'MAX'),
+    ('last_change_type', 'INT', 'AZ64', 'MAX'),
+    ('upgraded', 'BOOLEAN', 'ZSTD', 'bool_or'),
+    ('downgraded', 'BOOLEAN', 'ZSTD', 'bool_or'),
+    ('gift_cards', 'INT', 'AZ64', 'SUM'),
+    ('referral_invites', 'INT', 'AZ64', 'SUM'),
+    ('referral_emails', 'INT', 'AZ64', 'SUM'),
+    ('used_app', 'BOOLEAN', 'ZSTD', 'bool_or'),
+]
+
+
+def new_york_day(column):
+    return "DATE(convert_timezone('America/New_York', {}))".format(column)
+
+
+# Each source aggregates one fact table by user and New York calendar day
+# from refresh_from on. Boxes are already dated by delivery_date; the
+# schedules and nth deliveries of a day are kept as comma-wrapped lists so
+# that a single value can be matched with LIKE '%,value,%'.
+
+def boxes_source(refresh_from, refresh_from_utc):
+    return """SELECT internal_user_id AS user_id
+            , delivery_date AS activity_date
+            , COUNT(CASE WHEN delivery_schedule_type = 'normal'
+                THEN 1 END) AS normal_boxes
+            , ',' || LISTAGG(DISTINCT CASE
+                WHEN delivery_schedule_type = 'normal'
+                THEN delivery_schedule_name END, ',') || ','
+                AS delivery_schedules
+            , ',' || LISTAGG(DISTINCT CAST(nth_delivery AS VARCHAR), ',')
+                || ',' AS nth_deliveries
+            , SUM(gov) AS gov
+            , COUNT(CASE WHEN dessert_plates > 0 THEN 1 END)
+                AS dessert_boxes
+        FROM dw.menu_order_boxes
+        WHERE delivery_date >= '{}'
+            AND status <> 'canceled'
+        GROUP BY 1,2""".format(refresh_from)
+
+
+def status_changes_source(refresh_from, refresh_from_utc):
+    # the type of the last change of each day decides whether a user is
+    # active at the end of any later day
+    return """SELECT user_id
+            , activity_date
+            , bool_or(change_type = 0) AS activated
+            , bool_or(change_type = 1) AS reactivated
+            , bool_or(change_type = 2) AS canceled
+            , max(created_at) AS last_change_at
+            , max(CASE WHEN latest = 1 THEN change_type END)
+                AS last_change_type
+        FROM (
+            SELECT user_id
+                , change_type
+                , created_at
+                , {day} AS activity_date
+                , ROW_NUMBER() OVER (PARTITION BY user_id, {day}
+                    ORDER BY created_at DESC, change_type DESC) AS latest
+            FROM web.user_membership_status_changes
+            WHERE created_at >= {start}
+        ) c
+        GROUP BY 1,2""".format(day = new_york_day('created_at'),
+                               start = refresh_from_utc)
+
+
+def last_status_source(refresh_from, refresh_from_utc):
+    # a full refresh also keeps each user's last change before refresh_from,
+    # so users whose status has not changed since are still known to be
+    # active or not
+    return """SELECT user_id
+            , {day} AS activity_date
+            , created_at AS last_change_at
+            , change_type AS last_change_type
+        FROM (
+            SELECT user_id
+                , change_type
+                , created_at
+                , ROW_NUMBER() OVER (PARTITION BY user_id
+                    ORDER BY created_at DESC, change_type DESC) AS latest
+            FROM web.user_membership_status_changes
+            WHERE created_at < {start}
+        ) c
+        WHERE latest = 1""".format(day = new_york_day('created_at'),
+                                   start = refresh_from_utc)
+
+
+def plan_changes_source(refresh_from, refresh_from_utc):
+    return """SELECT user_id
+            , {day} AS activity_date
+            , bool_or(new_plan_plates > old_plan_plates) AS upgraded
+            , bool_or(new_plan_plates < old_plan_plates) AS downgraded
+        FROM (
+            SELECT user_id
+                , client_timestamp
+                , CAST(json_extract_path_text(properties,
+                    'new_plan_dinners') AS INT) *
+                  CAST(json_extract_path_text(properties,
+                    'new_plan_servings') AS INT) AS new_plan_plates
+                , CAST(json_extract_path_text(properties,
+                    'old_plan_dinners') AS INT) *
+                  CAST(json_extract_path_text(properties,
+                    'old_plan_servings') AS INT) AS old_plan_plates
+            FROM dw.web_track_events
+            WHERE event = 'Subscription Plan Changed'
+                AND client_timestamp >= {start}
+        ) wte
+        WHERE new_plan_plates <> old_plan_plates
+        GROUP BY 1,2""".format(day = new_york_day('client_timestamp'),
+                               start = refresh_from_utc)
+
+
+def gift_cards_source(refresh_from, refresh_from_utc):
+    return """SELECT sender_internal_user_id AS user_id
+            , {day} AS activity_date
+            , COUNT(*) AS gift_cards
+        FROM dw.gift_card_orders
+        WHERE gift_card_order_placed_at >= {start}
+        GROUP BY 1,2""".format(
+            day = new_york_day('gift_card_order_placed_at'),
+            start = refresh_from_utc)
+
+
+def referrals_source(refresh_from, refresh_from_utc):
+    return """SELECT referrer_internal_user_id AS user_id
+            , {day} AS activity_date
+            , COUNT(*) AS referral_invites
+            , COUNT(DISTINCT sent_to_email) AS referral_emails
+        FROM dw.user_referral_invites
+        WHERE sent_at >= {start}
+        GROUP BY 1,2""".format(day = new_york_day('sent_at'),
+                               start = refresh_from_utc)
+
+
+def app_usage_source(refresh_from, refresh_from_utc):
+    return """SELECT u.internal_user_id AS user_id
+            , {day} AS activity_date
+            , TRUE AS used_app
+        FROM (
+            SELECT external_user_id
+            , client_timestamp
+            FROM dw.app_track_events
+            WHERE client_timestamp >= {start}
+            UNION all
+            SELECT external_user_id
+            , client_timestamp
+            FROM dw.android_events
+            WHERE client_timestamp >= {start}
+        ) app_visits
+        INNER JOIN dw.users u
+            ON app_visits.external_user_id = u.external_id
+        GROUP BY 1,2""".format(day = new_york_day('client_timestamp'),
+                               start = refresh_from_utc)
+
+
+# source builder -> rollup columns it provides
+FACT_SOURCES = [
+    (boxes_source, ['normal_boxes', 'delivery_schedules', 'nth_deliveries',
+                    'gov', 'dessert_boxes']),
+    (status_changes_source, ['activated', 'reactivated', 'canceled',
+                             'last_change_at', 'last_change_type']),
+    (plan_changes_source, ['upgraded', 'downgraded']),
+    (gift_cards_source, ['gift_cards']),
+    (referrals_source, ['referral_invites', 'referral_emails']),
+    (app_usage_source, ['used_app']),
+]
+
+
+def daily_facts_ddl():
+    return """CREATE TABLE IF NOT EXISTS {tbl} (
+        user_id BIGINT ENCODE AZ64,
+        activity_date DATE ENCODE RAW,
+        {columns})
+    DISTKEY(user_id)
+    SORTKEY(activity_date, user_id)""".format(
+        tbl = DAILY_FACTS,
+        columns = ',\n        '.join('{} {} ENCODE {}'.format(
+            name, col_type, encoding)
+            for name, col_type, encoding, _ in FACT_COLUMNS))
+
+
+def daily_facts_query(refresh_from, seed = False):
+    # every source is padded to the full set of columns so that one
+    # GROUP BY merges the facts of a user and day into a single row
+    refresh_from_utc = "'{}'".format(
+        pd.Timestamp(refresh_from).tz_localize('America/New_York')
+        .tz_convert('UTC').strftime('%Y-%m-%d %H:%M:%S'))
+    fact_sources = FACT_SOURCES + ([(last_status_source,
+        ['last_change_at', 'last_change_type'])] if seed else [])
+    sources = []
+    for source, provided in fact_sources:
+        sources.append("""SELECT user_id
+            , activity_date
+            , {columns}
+        FROM (
+        {query}
+        ) s""".format(
+            columns = '\n            , '.join(
+                name if name in provided
+                else 'CAST(NULL AS {}) AS {}'.format(col_type, name)
+                for name, col_type, _, _ in FACT_COLUMNS),
+            query = source(refresh_from, refresh_from_utc)))
+
+    return """SELECT user_id
+        , activity_date
+        , {columns}
+    FROM (
+        {sources}
+    ) facts
+    WHERE user_id IS NOT NULL
+    GROUP BY 1,2""".format(
+        columns = '\n        , '.join('{}({}) AS {}'.format(agg, name, name)
+                                      for name, _, _, agg in FACT_COLUMNS),
+        sources = '\n        UNION ALL\n        '.join(sources))
+
+
+def last_daily_facts_refresh(engine):
+    # the watermark: when the last refresh started reading the raw tables
+    if not engine.has_table(DAILY_FACTS_REFRESHES.split('.')[1],
+                            schema = 'analytics'):
+        return None
+    refreshed_at = pd.read_sql_query('SELECT max(refreshed_at) AS refreshed_at '
+        'FROM {}'.format(DAILY_FACTS_REFRESHES), engine).refreshed_at.iloc[0]
+    return None if pd.isnull(refreshed_at) else pd.Timestamp(refreshed_at)
+
+
+def refresh_daily_facts(engine, usernames, lookback_days = 7, since = None):
+    # rows from refresh_from on are deleted and rebuilt from the raw tables;
+    # the lookback picks up late events and box status changes made after
+    # the last refresh
+    last_refresh = last_daily_facts_refresh(engine)
+    refreshed_at = pd.Timestamp.now('UTC').tz_localize(None)
+    if since is not None or last_refresh is None:
+        refresh_from = pd.Timestamp(since or FULL_REFRESH_START)
+    else:
+        refresh_from = (last_refresh.tz_localize('UTC')
+            .tz_convert('America/New_York').tz_localize(None).normalize()
+            - pd.Timedelta(days = lookback_days))
+    refresh_from = refresh_from.strftime('%Y-%m-%d')
+    # a full refresh rebuilds the whole table, seeded with the status every
+    # user had before it starts
+    seed = refresh_from <= FULL_REFRESH_START
+
+    with engine.begin() as connection:
+        connection.execute(daily_facts_ddl())
+        connection.execute("""CREATE TABLE IF NOT EXISTS {} (
+            refreshed_from DATE,
+            refreshed_at TIMESTAMP)""".format(DAILY_FACTS_REFRESHES))
+        deleted = connection.execute('DELETE FROM {}{}'.format(DAILY_FACTS,
+            '' if seed else " WHERE activity_date >= '{}'".format(
+                refresh_from))).rowcount
+        inserted = connection.execute('INSERT INTO {} {}'.format(
+            DAILY_FACTS, daily_facts_query(refresh_from,
+                                           seed = seed))).rowcount
+        connection.execute("INSERT INTO {} VALUES ('{}', '{}')".format(
+            DAILY_FACTS_REFRESHES, refresh_from,
+            refreshed_at.strftime('%Y-%m-%d %H:%M:%S')))
+        connection.execute('ANALYZE {}'.format(DAILY_FACTS))
+        grant_select(connection, DAILY_FACTS, usernames)
+
+    logging.info('Table {} refreshed from {}: {} rows deleted and {} rows '
+                 'inserted'.format(DAILY_FACTS, refresh_from, deleted,
+                                   inserted))
+
+
+def main(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format = '{asctime} {name:12s} {levelname:8s} {message}',
+        datefmt = '%m-%d %H:%M:%S',
+        style = '{',
+        stream=sys.stdout)
+
+    [logging.info('Input argument {} set to {}'.format(k, v))
+        for k,v in vars(args).items()]
+
+    if args.dry_run:
+        logging.info('DDL for {}:\n{}'.format(DAILY_FACTS, daily_facts_ddl()))
+        since = args.since or FULL_REFRESH_START
+        logging.info('Refresh query:\n{}'.format(daily_facts_query(since,
+            seed = pd.Timestamp(since) <= pd.Timestamp(FULL_REFRESH_START))))
+        return
+    engine = create_redshift_engine()
+    usernames = ['production_read_only', 'analytics_team', 'prod_application']
+    refresh_daily_facts(engine, usernames, lookback_days = args.lookback_days,
+                        since = args.since)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Refresh the per-user daily fact rollup read by '
+                            'metrics queries built with --from_rollup.')
+    parser.add_argument('--lookback_days', type = int, default = 7,
+        help = 'days before the last refresh that are rebuilt')
+    parser.add_argument('--since', default = None,
+        help = 'rebuild every day from this date on instead of from the '
+               'last refresh')
+    parser.add_argument('--dry_run', action = 'store_true',
+        help = 'print the table DDL and refresh query without running them')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,98 @@
+import logging, uuid
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from process_campaign.s3_read_write import S3ReadWrite
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def fetch_chunks(query, engine, chunksize = 100000, parse_dates = None):
+    # stream_results makes psycopg2 use a named server-side cursor, so
+    # only chunksize rows are held as Python objects at any time
+    with engine.connect() as connection:
+        connection = connection.execution_options(stream_results = True)
+        for chunk in pd.read_sql_query(query, connection,
+                                       chunksize = chunksize,
+                                       parse_dates = parse_dates):
+            yield chunk
+
+
+def downcast(chunk, categoricals = ()):
+    # booleans without NULLs become bool, counts that fit become int32 and
+    # repeated labels become categoricals
+    for col in chunk.columns:
+        values = chunk[col]
+        if col in categoricals:
+            # labels are text whatever a chunk inferred, so the categories
+            # of every chunk have the same dtype and can be unioned
+            chunk[col] = (values.astype(str).where(values.notnull())
+                          .astype('category'))
+        elif (values.dtype == object and values.notnull().all()
+              and values.map(type).eq(bool).all()):
+            chunk[col] = values.astype(bool)
+        elif (pd.api.types.is_integer_dtype(values) and
+              (not len(values) or values.abs().max() <= INT32_MAX)):
+            chunk[col] = values.astype(np.int32)
+    return chunk
+
+
+def combine_chunks(chunks, categoricals = ()):
+    # categories differ from chunk to chunk, so they are unioned rather
+    # than letting concat fall back to object columns; sorted categories
+    # order the report as text labels would, whatever order rows came in
+    frames = [downcast(chunk, categoricals) for chunk in chunks]
+    if not frames:
+        return pd.DataFrame()
+    columns = frames[0].columns
+    category_cols = [col for col in columns
+                     if isinstance(frames[0][col].dtype, pd.CategoricalDtype)]
+    data = pd.concat([frame.drop(columns = category_cols) for frame in frames],
+                     ignore_index = True)
+    for col in category_cols:
+        data[col] = union_categoricals([frame[col] for frame in frames],
+                                       sort_categories = True)
+    return data[columns]
+
+
+def fetch_frame(query, engine, parse_dates = None, categoricals = (),
+                chunksize = 100000):
+    data = combine_chunks(fetch_chunks(query, engine, chunksize = chunksize,
+                                       parse_dates = parse_dates),
+                          categoricals = categoricals)
+    logging.info('Fetched {:,} rows using {:,} bytes'.format(
+        len(data), data.memory_usage(deep = True).sum()))
+    return data
+
+
+def unload_frame(query, engine, bucket, s3dir, parse_dates = None,
+                 categoricals = (), iam = 308127741254,
+                 role = 'RedshiftCopy'):
+    # very large results are written by every slice to S3 as parquet and
+    # read back one part at a time instead of through the leader node. The
+    # parts come back in no particular order, which the report does not
+    # depend on since it is reshaped and ordered by its labels
+    iam_role = 'arn:aws:iam::{iam}:role/{role}'.format(iam=iam , role=role)
+    prefix = '{}/unload/{}/'.format(s3dir, uuid.uuid4().hex)
+    s3_reader = S3ReadWrite(bucket = bucket, folder = s3dir)
+    with engine.begin() as connection:
+        connection.execute("""UNLOAD ('{query}')
+        TO 's3://{bucket}/{prefix}'
+        iam_role '{iam_role}'
+        FORMAT AS PARQUET""".format(
+            query = query.replace("'", "''"),
+            bucket = bucket,
+            prefix = prefix,
+            iam_role = iam_role))
+    logging.info('Query unloaded to s3://{}/{}'.format(bucket, prefix))
+
+    try:
+        data = combine_chunks(s3_reader.read_parquet_parts_from_S3(prefix),
+                              categoricals = categoricals)
+    finally:
+        s3_reader.delete_prefix_from_S3(prefix)
+    for col in parse_dates or []:
+        data[col] = pd.to_datetime(data[col])
+    logging.info('Fetched {:,} rows using {:,} bytes'.format(
+        len(data), data.memory_usage(deep = True).sum()))
+    return data
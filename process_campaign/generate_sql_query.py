@@ -1,11 +1,18 @@
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import logging, re, sys
 from datetime import datetime
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
-from process_campaign.upload_redshift import extract_campaign_info
+from process_campaign.upload_redshift import (extract_campaign_info,
+    create_redshift_engine)
+from process_campaign.daily_facts import DAILY_FACTS, last_daily_facts_refresh
+from process_campaign.app_activity import (APP_ACTIVE_DAYS,
+    app_active_days_watermark)
+from process_campaign.fetch import fetch_frame, unload_frame
+from process_campaign.result_cache import (ResultCache, campaign_version,
+    data_version, load_watermark)
 
 def offer_redemption(tm):
     if not tm.offer_campaign_name.isnull().all():
@@ -31,195 +38,249 @@ def offer_redemption(tm):
         return ''
 
 
-def build_query(info, test_matrix):
-    tbl_name = 'analytics.{}'.format(
-        info.campaign_short_name.strip().lower())
-
-    promo_periods = (info[[col for col in info.dropna().index
-                          if col.endswith('_end_date')]]
-        .apply(lambda x: (x if x == 'current_date'
-                          else "'{}'".format(pd.to_datetime(x).date())
-                          )))
-    promo_periods.index = [x.replace('_end_date', '')
-                           for x in promo_periods.index]
-
-    start_date = pd.to_datetime(info.start_date).date()
-
-    promo_period_query = "\n    UNION ALL\n    ".join([
-        """SELECT '{}' AS promo_period,
-        {} AS end_date""".format(k, v)
-        for k,v in promo_periods.iteritems()])
-
-    discounts_query = offer_redemption(test_matrix)
-
-    campaign_lists = """SELECT DISTINCT a.*
-        , pp.*
-        {offer_redeemed}
-    FROM {tbl_name} a
-    {discounts_query}
-    CROSS JOIN (
-    {promo_period_query}
-    ) pp
-    WHERE a.target_name IN ({targets})
-    and a.user_id is not null
-    """.format(
-        tbl_name = tbl_name,
-        offer_redeemed =
-            ', md.internal_user_id IS NOT NULL AS offer_redeemed' \
-            if discounts_query != '' else '',
-        discounts_query = discounts_query,
-        promo_period_query = promo_period_query,
-        targets = ",\n".join(["'{}'".format(target)
-            for target in test_matrix.target_name]))
-
-    compose_full_query = """WITH campaign_lists AS (
-    {}),""".format(campaign_lists)
+def period_rank(column, bounds, comparison = '<='):
+    # rank of the first promo period whose bound covers column
+    return 'CASE {} END'.format(' '.join(
+        'WHEN {} {} {} THEN {}'.format(column, comparison, bound, rank)
+        for rank, bound in enumerate(bounds, 1)))
 
-    inc_subscription_changes = info[['cancelations', 'cancelation_rate',
-        'new_activations', 'activation_rate', 'reactivations',
-        'reactivation_rate']].any()
 
-    inc_active_at_end = info[['total_active_at_end', 'pct_active_at_end']].any()
+def new_york_day_start(day):
+    # UTC timestamp at which the New York calendar day starts, so that
+    # predicates compare raw UTC columns and Redshift can skip blocks by
+    # their zone maps instead of converting every row
+    return "'{}'".format(pd.Timestamp(day).tz_localize('America/New_York')
+        .tz_convert('UTC').strftime('%Y-%m-%d %H:%M:%S'))
 
-    inc_boxes_ordered = info[['total_boxes_ordered', 'avg_boxes_ordered', 'gov',
-        'aov', 'desserts_ordered', 'dessert_take_rate', 'ordered_nth_box',
-        'ordered_ds']].any()
 
-    inc_four_week_order = info[['total_ordered_week_4', 'pct_ordered_week_4',
-        'avg_num_boxes_first_4_weeks']].any()
+def metric_ctes(name, query, measures, bucketed):
+    # in bucketed mode query aggregates each user's events once by the first
+    # period they fall in, and the cumulative metrics for every period are
+    # rolled up from the buckets up to and including that period
+    if not bucketed or measures is None:
+        return """\n{} AS (
+        {}),""".format(name, query)
 
-    inc_upgrade_events = info[['total_upgrades', 'total_downgrades']].any()
-
-    inc_gift_card_orders = info['gift_cards_purchased']
-
-    inc_used_the_app = info['total_using_the_app']
-
-    inc_referrals = info['num_referrals_sent']
-
-    boolean_metrics = []
-    numeric_metrics = []
-    joins = []
-
-    if inc_subscription_changes:
-        subscription_changes = """SELECT a.user_id
-            , a.promo_period
-            {change_q} = 0) AS activated
-            {change_q} = 1) AS reactivated
-            {change_q} = 2) AS canceled
-        FROM campaign_lists a
-        INNER JOIN web.user_membership_status_changes use
-            ON a.user_id = use.user_id
-            AND DATE(convert_timezone('America/New_York',
-            created_at)) BETWEEN '{start_date}' AND a.end_date
+    cumulative = """SELECT b.user_id
+            , p.promo_period
+            {measures}
+        FROM {name}_buckets b
+        INNER JOIN periods p
+            ON b.period_rank <= p.period_rank
         GROUP BY 1,2
         """.format(
-            change_q = ', bool_or( change_type ',
-            start_date = start_date)
-
-        boolean_metrics.extend(['activated', 'reactivated', 'canceled'])
-        joins.append(('subscription_changes', 'sc'))
-
-        compose_full_query += """\nsubscription_changes AS (
-        {}),""".format(subscription_changes)
-
-    if inc_active_at_end:
-        last_change = """SELECT a.user_id
-            , a.promo_period
-            , max(use.created_at) last_change
-        FROM campaign_lists a
-        INNER JOIN web.user_membership_status_changes use
-            ON a.user_id = use.user_id
-            AND DATE(convert_timezone('America/New_York',
-            use.created_at)) <= a.end_date
+            name = name,
+            measures = '\n            '.join(measures))
+    return """\n{name}_buckets AS (
+        {query}),
+        {name} AS (
+        {cumulative}),""".format(
+            name = name, query = query, cumulative = cumulative)
+
+
+def box_measure_cols(info):
+    if not info.ordered_nth_box:
+        return []
+    boxes = [int(i) for i in info.ordered_nth_box.split(', ')]
+    return [(n, 'ordered_{}{}_box'.format(
+        n, 'st' if n==1 else 'nd' if n==2 else 'rd' if n==3 else 'th'))
+        for n in boxes]
+
+
+def ds_measure_cols(info):
+    if not info.ordered_ds:
+        return []
+    return [(int(info.ordered_ds), 'ordered_ds_{}'.format(
+        int(info.ordered_ds)))]
+
+
+def union_measure_cols(measure_cols, infos):
+    # measures of every campaign in a batch, each listed once
+    measures = []
+    for info in infos:
+        measures.extend(m for m in measure_cols(info) if m not in measures)
+    return measures
+
+
+def date_range(q, column, utc = True, since_start = True):
+    # predicates bounding column to the promo periods of each row, with
+    # literal bounds whenever the row bounds are columns so that zone maps
+    # still apply
+    bounds = ((q['starts_utc'] if utc else q['starts']) if since_start
+              else []) + (q['ends_utc'] if utc else q['ends'])
+    return '\n            AND '.join('{} {} {}'.format(column, comparison,
+                                                      bound)
+                                     for comparison, bound in bounds)
+
+
+# Each CTE below returns its query and, for CTEs joined per promo period,
+# the measures rolling its buckets up in bucketed mode. q holds the users
+# source, period bounds and period expression for the current mode.
+
+def membership_changes_query(q):
+    # one scan of the status changes serves the changes since the campaign
+    # started and the last change before each end_date along with its type
+    query = """SELECT user_id
+            , {period_col}
+            , bool_or(activated) AS activated
+            , bool_or(reactivated) AS reactivated
+            , bool_or(canceled) AS canceled
+            , max(created_at) AS last_change
+            , max(CASE WHEN latest = 1 THEN change_type END)
+                AS last_change_type
+        FROM (
+            SELECT c.*
+                , ROW_NUMBER() OVER (PARTITION BY user_id, {period_col}
+                    ORDER BY created_at DESC, change_type DESC) AS latest
+            FROM (
+                SELECT a.user_id
+                    , {period}
+                    , use.change_type
+                    , use.created_at
+                    {change_q} = 0 AS activated
+                    {change_q} = 1 AS reactivated
+                    {change_q} = 2 AS canceled
+                FROM {users} a
+                INNER JOIN web.user_membership_status_changes use
+                    ON a.user_id = use.user_id
+                    AND {date_range}
+            ) c
+        ) c
         GROUP BY 1,2
+        """.format(
+            period = q['period_of']('use.created_at', utc = True),
+            change_q = ', use.created_at >= {} AND use.change_type'.format(
+                q['start_utc']),
+            date_range = date_range(q, 'use.created_at',
+                                    since_start = False),
+            **q)
+    return query, [', bool_or(b.{a}) AS {a}'.format(a = a)
+                   for a in ['activated', 'reactivated', 'canceled']] + [
+                   ', max(b.last_change) AS last_change']
+
+
+def active_at_end_query(q):
+    # read from the type of each user's last change rather than scanning
+    # the status changes again; in bucketed mode the last change up to a
+    # period is that of its latest bucket
+    if not q['bucketed']:
+        query = """SELECT user_id
+            , promo_period
+            , last_change_type IN (0,1,4) AS active_at_end
+        FROM membership_changes
         """
-
-        active_at_end = """SELECT a.user_id
-            , a.promo_period
-            , change_type IN (0,1,4) AS active_at_end
-        FROM last_change a
-        INNER JOIN web.user_membership_status_changes use
-            ON a.user_id = use.user_id
-            AND last_change = use.created_at
+        return query, None
+
+    query = """SELECT user_id
+            , promo_period
+            , last_change_type IN (0,1,4) AS active_at_end
+        FROM (
+            SELECT b.user_id
+                , p.promo_period
+                , b.last_change_type
+                , ROW_NUMBER() OVER (PARTITION BY b.user_id, p.promo_period
+                    ORDER BY b.period_rank DESC) AS latest
+            FROM membership_changes_buckets b
+            INNER JOIN periods p
+                ON b.period_rank <= p.period_rank
+        ) c
+        WHERE latest = 1
         """
-
-        boolean_metrics.append('active_at_end')
-        joins.append(('active_at_end', 'ae'))
-        compose_full_query += """\nlast_change AS (
-        {}),
-        active_at_end AS (
-        {}),""".format(last_change, active_at_end)
-
-    if inc_boxes_ordered:
-        if info.ordered_nth_box:
-            boxes = [int(i) for i in info.ordered_nth_box.split(', ')]
-            box_measure_cols = ['ordered_{}{}_box'.format(
-                n, 'st' if n==1 else 'nd' if n==2 else 'rd' if n==3 else 'th'
-            ) for n in boxes]
-            box_measures = [', bool_or( nth_delivery = {}) AS {}'.format(
-                    n, colname) for n, colname
-                    in zip(boxes, box_measure_cols)]
-            boolean_metrics.extend(box_measure_cols)
-        else:
-            box_measures = []
-
-        if info.ordered_ds:
-            ds_measure_col = 'ordered_ds_{}'.format(int(info.ordered_ds))
-            ds_ordered = """, bool_or(mob.delivery_schedule_name = '{ds}')
-                AS ordered_ds_{ds}""".format(ds = int(info.ordered_ds))
-            boolean_metrics.append(ds_measure_col)
-
-        else:
-            ds_ordered = ""
-
-        mob = """SELECT a.user_id
-            , a.promo_period
-            , delivery_schedule_name,
-            min(delivery_date) AS delivery_date
-        FROM campaign_lists a
-        INNER JOIN dw.menu_order_boxes bo
-            ON bo.internal_user_id = a.user_id
-            AND delivery_date BETWEEN '{start_date}' AND a.end_date
-            AND status <> 'canceled'
-            AND delivery_schedule_type = 'normal'
-        GROUP BY 1,2,3
-        """.format(start_date = start_date)
-
-        boxes_ordered = """SELECT mob.user_id
-            , mob.promo_period
-            , COUNT(DISTINCT mob.delivery_date) AS total_boxes_ordered
-            {box_measures_joined}
-            {ds_ordered}
+    return query, None
+
+
+def mob_query(q):
+    # one scan of the boxes serves the first delivery of every schedule and
+    # the boxes delivered on those dates: one row per user, period and date
+    # on which at least one normal schedule was first delivered. A schedule
+    # is bucketed by its first delivery, so the dates of different buckets
+    # never overlap
+    boxes = union_measure_cols(box_measure_cols, q['infos'])
+    schedules = union_measure_cols(ds_measure_cols, q['infos'])
+    measures = ''.join("""
+            , bool_or(nth_delivery = {}) AS {}""".format(n, colname)
+        for n, colname in boxes) + ''.join("""
+            , bool_or(first_delivery AND delivery_schedule_name = '{}')
+                AS {}""".format(ds, colname) for ds, colname in schedules)
+
+    query = """SELECT user_id
+            , {period_col}
+            , delivery_date
+            , SUM(CASE WHEN first_delivery THEN 1 ELSE 0 END)
+                AS first_deliveries{measures}
             , SUM(gov) AS gov
-            , SUM( CASE WHEN dessert_plates > 0 THEN 1 END )
-                AS desserts_ordered
+            , SUM( CASE WHEN dessert_plates > 0 THEN 1 END ) AS dessert_boxes
+        FROM (
+            SELECT a.user_id
+                , {period}
+                , bo.delivery_date
+                , bo.delivery_schedule_name
+                , bo.nth_delivery
+                , bo.gov
+                , bo.dessert_plates
+                , bo.delivery_schedule_type = 'normal' AND ROW_NUMBER() OVER (
+                    PARTITION BY a.user_id{first_within},
+                        bo.delivery_schedule_name
+                    ORDER BY CASE WHEN bo.delivery_schedule_type = 'normal'
+                        THEN 0 ELSE 1 END, bo.delivery_date) = 1
+                    AS first_delivery
+            FROM {users} a
+            INNER JOIN dw.menu_order_boxes bo
+                ON bo.internal_user_id = a.user_id
+                AND {date_range}
+                AND bo.status <> 'canceled'
+        ) c
+        GROUP BY 1,2,3
+        HAVING bool_or(first_delivery)
+        """.format(
+            period = q['period_of']('bo.delivery_date'),
+            first_within = '' if q['bucketed'] else ', a.promo_period',
+            measures = measures,
+            date_range = date_range(q, 'bo.delivery_date', utc = False),
+            **q)
+    return query, None
+
+
+def boxes_ordered_query(q):
+    # boxes delivered on a date count once for every schedule first
+    # delivered that day
+    boxes = union_measure_cols(box_measure_cols, q['infos'])
+    schedules = union_measure_cols(ds_measure_cols, q['infos'])
+    measures = ''.join("""
+            , bool_or({a}) AS {a}""".format(a = col)
+        for _, col in boxes + schedules)
+
+    query = """SELECT user_id
+            , {period_col}
+            , COUNT(*) AS total_boxes_ordered{measures}
+            , SUM(first_deliveries * gov) AS gov
+            , SUM(first_deliveries * dessert_boxes) AS desserts_ordered
         FROM mob
-        INNER JOIN dw.menu_order_boxes bo
-            ON bo.internal_user_id = mob.user_id
-            AND bo.delivery_date = mob.delivery_date
-            AND bo.status <> 'canceled'
         GROUP BY 1,2
-        """.format(
-            box_measures_joined = '\n    '.join(box_measures),
-            ds_ordered = ds_ordered,
-            start_date = start_date)
-
-        numeric_metrics.extend(['total_boxes_ordered', 'gov',
-            'desserts_ordered'])
-        joins.append(('boxes_ordered', 'bo'))
-        compose_full_query += """\nmob AS (
-        {}),
-        boxes_ordered AS (
-        {}),""".format(mob, boxes_ordered)
-
-    if inc_four_week_order:
-        cohorts = """select user_id
+        """.format(measures = measures, **q)
+    return query, [', SUM(b.{a}) AS {a}'.format(a = a)
+        for a in ['total_boxes_ordered', 'gov', 'desserts_ordered']] + [
+        ', bool_or(b.{a}) AS {a}'.format(a = col)
+        for _, col in boxes + schedules]
+
+
+def cohorts_query(q):
+    # in a batch each campaign has its own cohort for the same user
+    query = """select user_id
+            {campaign}
             , min(delivery_date) as first_delivery_date
         FROM mob
-        GROUP BY 1
-        """
+        GROUP BY {group_by}
+        """.format(
+            campaign = ', {} AS campaign'.format(
+                q['campaign_of']('promo_period')) if q['batch'] else '',
+            group_by = '1,2' if q['batch'] else '1')
+    return query, None
+
 
-        four_week_order = """SELECT mob.user_id
+def four_week_order_query(q):
+    query = """SELECT mob.user_id
+            {campaign}
             , COUNT(DISTINCT mob.delivery_date) AS num_boxes_first_4_weeks
             , bool_or(datediff('week', cohorts.first_delivery_date,
                 mob.delivery_date) = 3)
@@ -227,22 +288,21 @@ def build_query(info, test_matrix):
         FROM cohorts
         INNER JOIN mob
             ON cohorts.user_id = mob.user_id
+            {same_campaign}
             AND datediff('week', cohorts.first_delivery_date,
             mob.delivery_date) < 4
-        GROUP BY 1
-        """
+        GROUP BY {group_by}
+        """.format(
+            campaign = ', cohorts.campaign' if q['batch'] else '',
+            same_campaign = 'AND cohorts.campaign = {}'.format(
+                q['campaign_of']('mob.promo_period')) if q['batch'] else '',
+            group_by = '1,2' if q['batch'] else '1')
+    return query, None
 
-        boolean_metrics.append('ordered_week_4')
-        numeric_metrics.append('num_boxes_first_4_weeks')
-        joins.append(('four_week_order', 'fwo'))
-        compose_full_query += """\ncohorts AS (
-        {}),
-        four_week_order AS (
-        {}),""".format(cohorts, four_week_order)
-
-    if inc_upgrade_events:
-        upgrade_events_raw = """SELECT a.user_id
-            , a.promo_period
+
+def upgrade_events_raw_query(q):
+    query = """SELECT a.user_id
+            , {period}
             , CAST(json_extract_path_text(properties,
                 'new_plan_dinners') AS INT) *
               CAST(json_extract_path_text(properties,
@@ -251,95 +311,611 @@ def build_query(info, test_matrix):
                 'old_plan_dinners') AS INT) *
               CAST(json_extract_path_text(properties,
                 'old_plan_servings') AS INT) AS old_plan_plates
-        FROM campaign_lists a
+        FROM {users} a
         INNER JOIN dw.web_track_events wte
             ON wte.user_id = a.user_id
             AND wte.event = 'Subscription Plan Changed'
-            AND DATE(convert_timezone('America/New_York',
-            client_timestamp))
-            BETWEEN '{start_date}' AND a.end_date
-        """.format(start_date = start_date)
+            AND {date_range}
+        """.format(
+            period = q['period_of']('wte.client_timestamp', utc = True),
+            date_range = date_range(q, 'wte.client_timestamp'),
+            **q)
+    return query, None
 
-        upgrade_events = """SELECT a.user_id
-            , a.promo_period
+
+def upgrade_events_query(q):
+    query = """SELECT a.user_id
+            , a.{period_col}
             , bool_or(new_plan_plates > old_plan_plates) AS upgraded
             , bool_or(new_plan_plates < old_plan_plates) AS downgraded
         FROM upgrade_events_raw a
         WHERE new_plan_plates <> old_plan_plates
         GROUP BY 1,2
-        """
+        """.format(**q)
+    return query, [', bool_or(b.{a}) AS {a}'.format(a = a)
+                   for a in ['upgraded', 'downgraded']]
 
-        boolean_metrics.extend(['upgraded', 'downgraded'])
-        joins.append(('upgrade_events', 'ue'))
-        compose_full_query += """\nupgrade_events_raw AS (
-        {}),
-        upgrade_events AS (
-        {}),""".format(upgrade_events_raw, upgrade_events)
 
-    if inc_gift_card_orders:
-        gift_card_orders = """SELECT a.user_id
-            , a.promo_period
+def gift_card_orders_query(q):
+    # one row per user and period, however many cards were bought
+    query = """SELECT a.user_id
+            , {period}
             , TRUE as gift_card_purchase
-        FROM campaign_lists a
+        FROM {users} a
         INNER JOIN dw.gift_card_orders gco
             ON gco.sender_internal_user_id = a.user_id
-            AND DATE(convert_timezone('America/New_York',
-                gift_card_order_placed_at))
-            BETWEEN '{start_date}' AND a.end_date
-        """.format(start_date = start_date)
-
-        boolean_metrics.append('gift_card_purchase')
-        joins.append(('gift_card_orders', 'gc'))
-        compose_full_query += """\ngift_card_orders AS (
-        {}),""".format(gift_card_orders)
-
-    if inc_used_the_app:
-        used_the_app = """SELECT a.user_id
-            , a.promo_period
+            AND {date_range}
+        GROUP BY 1,2
+        """.format(
+            period = q['period_of']('gco.gift_card_order_placed_at',
+                                    utc = True),
+            date_range = date_range(q, 'gco.gift_card_order_placed_at'),
+            **q)
+    return query, [', bool_or(b.gift_card_purchase) AS gift_card_purchase']
+
+
+def used_the_app_query(q):
+    # a day is in a period from its start_date on, as long as its first
+    # event is no later than end_date, which is exactly when the raw events
+    # of that day would have matched
+    query = """SELECT a.user_id
+            , {period}
+            , TRUE as used_the_app
+        FROM {users} a
+        INNER JOIN {app_active_days} d
+            ON d.internal_user_id = a.user_id
+            AND {since_start}
+            AND {until_end}
+            AND d.active_date <= {last_end_date}
+        GROUP BY 1,2
+        """.format(
+            period = q['period_of']('d.first_seen'),
+            app_active_days = APP_ACTIVE_DAYS,
+            since_start = '\n            AND '.join('d.active_date {} {}'.format(
+                comparison, bound) for comparison, bound in q['starts']),
+            until_end = '\n            AND '.join('d.first_seen {} {}'.format(
+                comparison, bound) for comparison, bound in q['ends']),
+            **q)
+    return query, [', bool_or(b.used_the_app) AS used_the_app']
+
+
+def referrals_query(q):
+    # distinct emails are not additive across buckets, so buckets keep
+    # each email and the cumulative rollup counts them
+    query = """SELECT a.user_id
+            , {period}
+            {measures}
+        FROM {users} a
+        INNER JOIN dw.user_referral_invites r
+            ON r.referrer_internal_user_id = a.user_id
+            AND {date_range}
+        GROUP BY {group_by}
+        """.format(
+            period = q['period_of']('r.sent_at', utc = True),
+            date_range = date_range(q, 'r.sent_at'),
+            measures = ', sent_to_email' if q['bucketed'] else
+                """, COUNT(DISTINCT sent_to_email) AS num_referrals_sent
+            , TRUE AS sent_referral""",
+            group_by = '1,2,3' if q['bucketed'] else '1,2',
+            **q)
+    return query, [', COUNT(DISTINCT b.sent_to_email) AS num_referrals_sent',
+                   ', TRUE AS sent_referral']
+
+
+# Rollup mode: the same CTEs read analytics.campaign_user_daily_facts, one
+# row per user and New York day, instead of the raw fact tables. A day
+# counts towards a period if it falls between its start and end dates.
+
+def rollup_facts(q, condition, since_start = True):
+    return """FROM {users} a
+        INNER JOIN {facts} f
+            ON f.user_id = a.user_id
+            AND {condition}
+            AND {date_range}""".format(
+        facts = DAILY_FACTS, condition = condition,
+        date_range = date_range(q, 'f.activity_date', utc = False,
+                                since_start = since_start),
+        **q)
+
+
+def membership_changes_rollup_query(q):
+    query = """SELECT user_id
+            , {period_col}
+            , bool_or(activated) AS activated
+            , bool_or(reactivated) AS reactivated
+            , bool_or(canceled) AS canceled
+            , max(last_change_at) AS last_change
+            , max(CASE WHEN latest = 1 THEN last_change_type END)
+                AS last_change_type
+        FROM (
+            SELECT c.*
+                , ROW_NUMBER() OVER (PARTITION BY user_id, {period_col}
+                    ORDER BY last_change_at DESC) AS latest
+            FROM (
+                SELECT a.user_id
+                    , {period}
+                    , f.activated AND f.activity_date >= {start_date}
+                        AS activated
+                    , f.reactivated AND f.activity_date >= {start_date}
+                        AS reactivated
+                    , f.canceled AND f.activity_date >= {start_date}
+                        AS canceled
+                    , f.last_change_at
+                    , f.last_change_type
+                {facts}
+            ) c
+        ) c
+        GROUP BY 1,2
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            facts = rollup_facts(q, 'f.last_change_at IS NOT NULL',
+                                 since_start = False),
+            **q)
+    return query, [', bool_or(b.{a}) AS {a}'.format(a = a)
+                   for a in ['activated', 'reactivated', 'canceled']] + [
+                   ', max(b.last_change) AS last_change']
+
+
+def mob_rollup_query(q):
+    query = """SELECT a.user_id
+            , {period}
+            , f.activity_date AS delivery_date
+        {facts}
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            facts = rollup_facts(q, 'f.normal_boxes > 0'))
+    return query, None
+
+
+def boxes_ordered_rollup_query(q):
+    # days with a normal delivery stand in for the first delivery of each
+    # schedule; gov and desserts count every box delivered on those days
+    boxes = union_measure_cols(box_measure_cols, q['infos'])
+    schedules = union_measure_cols(ds_measure_cols, q['infos'])
+    measures = ''.join("""
+            , bool_or(f.{column} LIKE '%,{value},%') AS {colname}""".format(
+        column = column, value = value, colname = colname)
+        for column, measure_cols in [('nth_deliveries', boxes),
+                                     ('delivery_schedules', schedules)]
+        for value, colname in measure_cols)
+
+    query = """SELECT a.user_id
+            , {period}
+            , COUNT(*) AS total_boxes_ordered{measures}
+            , SUM(f.gov) AS gov
+            , SUM(f.dessert_boxes) AS desserts_ordered
+        {facts}
+        GROUP BY 1,2
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            measures = measures,
+            facts = rollup_facts(q, 'f.normal_boxes > 0'))
+    return query, [', SUM(b.{a}) AS {a}'.format(a = a)
+        for a in ['total_boxes_ordered', 'gov', 'desserts_ordered']] + [
+        ', bool_or(b.{a}) AS {a}'.format(a = col)
+        for _, col in boxes + schedules]
+
+
+def upgrade_events_rollup_query(q):
+    query = """SELECT a.user_id
+            , {period}
+            , bool_or(f.upgraded) AS upgraded
+            , bool_or(f.downgraded) AS downgraded
+        {facts}
+        GROUP BY 1,2
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            facts = rollup_facts(q, '(f.upgraded OR f.downgraded)'))
+    return query, [', bool_or(b.{a}) AS {a}'.format(a = a)
+                   for a in ['upgraded', 'downgraded']]
+
+
+def gift_card_orders_rollup_query(q):
+    query = """SELECT a.user_id
+            , {period}
+            , TRUE as gift_card_purchase
+        {facts}
+        GROUP BY 1,2
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            facts = rollup_facts(q, 'f.gift_cards > 0'))
+    return query, [', bool_or(b.gift_card_purchase) AS gift_card_purchase']
+
+
+def used_the_app_rollup_query(q):
+    query = """SELECT a.user_id
+            , {period}
             , TRUE as used_the_app
-        FROM campaign_lists a
-        INNER JOIN dw.users u
-            ON a.user_id = u.internal_user_id
-        INNER JOIN (
-            SELECT external_user_id
-            , client_timestamp
-            FROM dw.app_track_events
-            WHERE DATE(client_timestamp) >= '{start_date}'
-            UNION all
-            SELECT external_user_id
-            , client_timestamp
-            FROM dw.android_events
-            WHERE DATE(client_timestamp) >= '{start_date}'
-        ) app_visits
-            ON app_visits.external_user_id = u.external_id
-            AND client_timestamp <= a.end_date
+        {facts}
         GROUP BY 1,2
-        """.format(start_date = start_date)
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            facts = rollup_facts(q, 'f.used_app'))
+    return query, [', bool_or(b.used_the_app) AS used_the_app']
 
-        boolean_metrics.append('used_the_app')
-        joins.append(('used_the_app', 'app'))
-        compose_full_query += """\nused_the_app AS (
-        {}),""".format(used_the_app)
 
-    if inc_referrals:
-        referrals_q = """SELECT a.user_id
-            , a.promo_period
-            , COUNT(DISTINCT sent_to_email) AS num_referrals_sent
+def referrals_rollup_query(q):
+    # emails are counted once per day they were sent to
+    query = """SELECT a.user_id
+            , {period}
+            , SUM(f.referral_emails) AS num_referrals_sent
             , TRUE AS sent_referral
-        FROM campaign_lists a
-        INNER JOIN dw.user_referral_invites r
-            ON r.referrer_internal_user_id = a.user_id
-            AND DATE(convert_timezone('America/New_York',
-                sent_at))
-            BETWEEN '{start_date}' AND a.end_date
+        {facts}
         GROUP BY 1,2
-        """.format(start_date = start_date)
+        """.format(
+            period = q['period_of']('f.activity_date'),
+            facts = rollup_facts(q, 'f.referral_invites > 0'))
+    return query, [', SUM(b.num_referrals_sent) AS num_referrals_sent',
+                   ', TRUE AS sent_referral']
+
+
+# CTE name -> CTEs it reads from, fact tables it scans and query builder
+QUERY_CTES = {
+    'membership_changes': dict(depends = [],
+        sources = ['web.user_membership_status_changes'],
+        build = membership_changes_query),
+    'active_at_end': dict(depends = ['membership_changes'],
+        sources = [],
+        build = active_at_end_query),
+    'mob': dict(depends = [],
+        sources = ['dw.menu_order_boxes'],
+        build = mob_query),
+    'boxes_ordered': dict(depends = ['mob'],
+        sources = [],
+        build = boxes_ordered_query),
+    'cohorts': dict(depends = ['mob'],
+        sources = [],
+        build = cohorts_query),
+    'four_week_order': dict(depends = ['cohorts', 'mob'],
+        sources = [],
+        build = four_week_order_query),
+    'upgrade_events_raw': dict(depends = [],
+        sources = ['dw.web_track_events'],
+        build = upgrade_events_raw_query),
+    'upgrade_events': dict(depends = ['upgrade_events_raw'],
+        sources = [],
+        build = upgrade_events_query),
+    'gift_card_orders': dict(depends = [],
+        sources = ['dw.gift_card_orders'],
+        build = gift_card_orders_query),
+    'used_the_app': dict(depends = [],
+        sources = [APP_ACTIVE_DAYS],
+        build = used_the_app_query),
+    'referrals': dict(depends = [],
+        sources = ['dw.user_referral_invites'],
+        build = referrals_query),
+}
+
+# the same CTEs in rollup mode
+ROLLUP_CTES = {
+    'membership_changes': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = membership_changes_rollup_query),
+    'active_at_end': dict(depends = ['membership_changes'],
+        sources = [],
+        build = active_at_end_query),
+    'mob': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = mob_rollup_query),
+    'boxes_ordered': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = boxes_ordered_rollup_query),
+    'cohorts': dict(depends = ['mob'],
+        sources = [],
+        build = cohorts_query),
+    'four_week_order': dict(depends = ['cohorts', 'mob'],
+        sources = [],
+        build = four_week_order_query),
+    'upgrade_events': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = upgrade_events_rollup_query),
+    'gift_card_orders': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = gift_card_orders_rollup_query),
+    'used_the_app': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = used_the_app_rollup_query),
+    'referrals': dict(depends = [],
+        sources = [DAILY_FACTS],
+        build = referrals_rollup_query),
+}
+
+# metric groups in output order: the template KPIs that enable them, the
+# CTE individual_metrics joins for their columns and the columns it adds;
+# four_week_order is computed once per user rather than per period
+METRICS = [
+    ('subscription_changes', dict(
+        kpis = ['cancelations', 'cancelation_rate', 'new_activations',
+                'activation_rate', 'reactivations', 'reactivation_rate'],
+        cte = 'membership_changes', alias = 'sc',
+        booleans = ['activated', 'reactivated', 'canceled'])),
+    ('active_at_end', dict(
+        kpis = ['total_active_at_end', 'pct_active_at_end'],
+        cte = 'active_at_end', alias = 'ae',
+        booleans = ['active_at_end'])),
+    ('boxes_ordered', dict(
+        kpis = ['total_boxes_ordered', 'avg_boxes_ordered', 'gov', 'aov',
+                'desserts_ordered', 'dessert_take_rate', 'ordered_nth_box',
+                'ordered_ds'],
+        cte = 'boxes_ordered', alias = 'bo',
+        booleans = lambda info: [col for _, col in box_measure_cols(info)
+                                 + ds_measure_cols(info)],
+        numerics = ['total_boxes_ordered', 'gov', 'desserts_ordered'])),
+    ('four_week_order', dict(
+        kpis = ['total_ordered_week_4', 'pct_ordered_week_4',
+                'avg_num_boxes_first_4_weeks'],
+        cte = 'four_week_order', alias = 'fwo', per_period = False,
+        booleans = ['ordered_week_4'],
+        numerics = ['num_boxes_first_4_weeks'])),
+    ('upgrade_events', dict(
+        kpis = ['total_upgrades', 'total_downgrades'],
+        cte = 'upgrade_events', alias = 'ue',
+        booleans = ['upgraded', 'downgraded'])),
+    ('gift_card_orders', dict(
+        kpis = ['gift_cards_purchased'],
+        cte = 'gift_card_orders', alias = 'gc',
+        booleans = ['gift_card_purchase'])),
+    ('used_the_app', dict(
+        kpis = ['total_using_the_app'],
+        cte = 'used_the_app', alias = 'app',
+        booleans = ['used_the_app'])),
+    ('referrals', dict(
+        kpis = ['num_referrals_sent'],
+        cte = 'referrals', alias = 'ref',
+        booleans = ['sent_referral'],
+        numerics = ['num_referrals_sent'])),
+]
+
+
+def metric_columns(metric, info):
+    columns = [metric.get(kind, []) for kind in ('booleans', 'numerics')]
+    return [cols(info) if callable(cols) else cols for cols in columns]
+
+
+def required_metrics(info):
+    metrics = [name for name, metric in METRICS
+               if info[metric['kpis']].any()]
+    # the responder flag is read from individual_metrics, so the metric
+    # groups of every column its expression names are needed even if none
+    # of their KPIs are reported
+    if info.responder_action != 1:
+        names = set(re.findall(r'[a-z_][a-z0-9_]*',
+                               str(info.responder_action).lower()))
+        metrics.extend(name for name, metric in METRICS
+            if names.intersection(sum(metric_columns(metric, info), []))
+            and name not in metrics)
+    return [name for name, _ in METRICS if name in metrics]
+
+
+def required_ctes(ctes, registry = QUERY_CTES):
+    # CTEs needed to compute ctes, each listed after the CTEs it reads from
+    ordered = []
+    def visit(name):
+        if name not in ordered:
+            for dependency in registry[name]['depends']:
+                visit(dependency)
+            ordered.append(name)
+    for name in ctes:
+        visit(name)
+    return ordered
+
+
+def promo_periods_of(info):
+    # promo period -> end_date as SQL, and the date each period ends on;
+    # Redshift's current_date is the UTC date
+    promo_periods = (info[[col for col in info.dropna().index
+                          if col.endswith('_end_date')]]
+        .apply(lambda x: (x if x == 'current_date'
+                          else "'{}'".format(pd.to_datetime(x).date())
+                          )))
+    promo_periods.index = [x.replace('_end_date', '')
+                           for x in promo_periods.index]
+    period_ends = promo_periods.map(lambda x:
+        pd.Timestamp.now('UTC').tz_localize(None).normalize()
+        if x == 'current_date' else pd.to_datetime(x.strip("'")))
+    return promo_periods, period_ends
+
+
+def campaign_lists_query(info, test_matrix, batch = False,
+                         offer_redeemed = False):
+    tbl_name = 'analytics.{}'.format(
+        info.campaign_short_name.strip().lower())
+    promo_periods, period_ends = promo_periods_of(info)
+    start_date = pd.to_datetime(info.start_date).date()
+    end_bounds = period_ends.map(lambda x:
+        new_york_day_start(x + pd.Timedelta(days = 1)))
+
+    if batch:
+        # promo_period is keyed by campaign so that every metric CTE keeps
+        # the campaigns apart without changing its grouping
+        campaign = info.campaign_short_name.strip().lower()
+        promo_period_query = "\n    UNION ALL\n    ".join([
+            """SELECT '{campaign}' AS campaign,
+        '{campaign}|{k}' AS promo_period,
+        '{k}' AS period_name,
+        CAST('{start_date}' AS DATE) AS start_date,
+        CAST({start_utc} AS TIMESTAMP) AS start_after_utc,
+        {v} AS end_date,
+        CAST({end_utc} AS TIMESTAMP) AS end_before_utc""".format(
+                campaign = campaign, k = k, v = v,
+                start_date = start_date,
+                start_utc = new_york_day_start(start_date),
+                end_utc = end_bounds[k])
+            for k,v in promo_periods.iteritems()])
+    else:
+        promo_period_query = "\n    UNION ALL\n    ".join([
+            """SELECT '{}' AS promo_period,
+        {} AS end_date,
+        CAST({} AS TIMESTAMP) AS end_before_utc""".format(
+                k, v, end_bounds[k])
+            for k,v in promo_periods.iteritems()])
+
+    discounts_query = offer_redemption(test_matrix)
+    if discounts_query != '':
+        offer_redeemed = ', md.internal_user_id IS NOT NULL AS offer_redeemed'
+    elif offer_redeemed:
+        offer_redeemed = ', FALSE AS offer_redeemed'
+    else:
+        offer_redeemed = ''
+
+    # send lists only hold ids and target_name; the rest of the test
+    # matrix lives in its own small table. Batched campaign tables are
+    # unioned, so only the columns they share are kept and test matrix
+    # columns are cast to one type whatever each table inferred
+    tm_col = 'CAST(tm.{0} AS VARCHAR(1024)) AS {0}' if batch else 'tm.{0}'
+    return """SELECT DISTINCT a.*
+        , pp.*
+        {offer_redeemed}
+    FROM (
+        SELECT {campaign_cols}
+            {test_matrix_cols}
+        FROM {tbl_name} c
+        INNER JOIN {tbl_name}_test_matrix tm
+            ON tm.target_name = c.target_name
+    ) a
+    {discounts_query}
+    CROSS JOIN (
+    {promo_period_query}
+    ) pp
+    WHERE a.user_id is not null
+    """.format(
+        tbl_name = tbl_name,
+        campaign_cols = 'c.user_id, c.target_name' if batch else 'c.*',
+        test_matrix_cols = '\n            '.join(', ' + tm_col.format(col)
+            for col in test_matrix.columns if col != 'target_name'),
+        offer_redeemed = offer_redeemed,
+        discounts_query = discounts_query,
+        promo_period_query = promo_period_query)
+
+
+def campaign_columns(info):
+    # boolean and numeric columns of individual_metrics a campaign reports
+    booleans, numerics = [], []
+    for name in required_metrics(info):
+        metric_booleans, metric_numerics = metric_columns(
+            dict(METRICS)[name], info)
+        booleans.extend(metric_booleans)
+        numerics.extend(metric_numerics)
+    if info.redeemed_offer_discount:
+        booleans.append('offer_redeemed')
+    return booleans, numerics
 
-        numeric_metrics.append('num_referrals_sent')
-        boolean_metrics.append('sent_referral')
-        joins.append(('referrals', 'ref'))
-        compose_full_query += """\nreferrals AS (
-        {}),""".format(referrals_q)
+
+def build_query(info, test_matrix, bucketed = False, rollup = False):
+    return compose_query([(info, test_matrix)], bucketed = bucketed,
+                         rollup = rollup)
+
+
+def build_batch_query(campaigns, rollup = False):
+    # one query over several (info, test_matrix) campaigns, scanning each
+    # fact table once; rows are tagged by campaign_short_name
+    tm_cols = list(campaigns[0][1].columns)
+    mismatched = [info.campaign_name for info, test_matrix in campaigns
+                  if list(test_matrix.columns) != tm_cols]
+    if mismatched:
+        raise ValueError('Test matrix columns of {} differ from {}'.format(
+            ', '.join(mismatched), campaigns[0][0].campaign_name))
+    return compose_query(campaigns, batch = True, rollup = rollup)
+
+
+def compose_query(campaigns, bucketed = False, batch = False,
+                  rollup = False):
+    infos = [info for info, _ in campaigns]
+    test_matrix = campaigns[0][1]
+    offer_redeemed = any(info.redeemed_offer_discount for info in infos)
+    # batched arms are unioned, so once any arm joins its discounts every
+    # arm needs an offer_redeemed column
+    offer_column = offer_redeemed or (batch and any(
+        offer_redemption(tm) != '' for _, tm in campaigns))
+
+    compose_full_query = """WITH campaign_lists AS (
+    {}),""".format("\n    UNION ALL\n    ".join(
+        campaign_lists_query(info, tm, batch = batch,
+                             offer_redeemed = offer_column)
+        for info, tm in campaigns))
+
+    # literal bounds of all the periods let every fact table scan skip
+    # blocks outside them, whatever the period of the row
+    starts = [pd.to_datetime(info.start_date).date() for info in infos]
+    promo_periods, period_ends = [pd.concat(x) for x in
+                                  zip(*map(promo_periods_of, infos))]
+    last_period = period_ends.values.argmax()
+    last_end_date = promo_periods.iloc[last_period]
+    last_end_utc = new_york_day_start(period_ends.iloc[last_period]
+                                      + pd.Timedelta(days = 1))
+    start_date = "'{}'".format(min(starts))
+    start_utc = new_york_day_start(min(starts))
+
+    q = dict(infos = infos, bucketed = bucketed, batch = batch,
+             start_date = start_date, start_utc = start_utc,
+             last_end_date = last_end_date,
+             starts = [('>=', start_date)],
+             starts_utc = [('>=', start_utc)])
+    if bucketed:
+        # fact tables are scanned once per user up to the last end_date
+        periods = sorted(promo_periods.items(),
+                         key = lambda x: period_ends[x[0]])
+        end_bounds = [new_york_day_start(period_ends[k]
+                                         + pd.Timedelta(days = 1))
+                      for k, _ in periods]
+        compose_full_query += """
+        periods AS (
+        {periods}),
+        campaign_users AS (
+        SELECT DISTINCT user_id
+        FROM campaign_lists),""".format(
+            periods = "\n    UNION ALL\n    ".join([
+                """SELECT '{}' AS promo_period,
+        {} AS end_date,
+        {} AS period_rank""".format(k, v, rank)
+                for rank, (k, v) in enumerate(periods, 1)]))
+
+        q.update(users = 'campaign_users', end_date = last_end_date,
+            period_col = 'period_rank',
+            ends = [('<=', last_end_date)],
+            ends_utc = [('<', last_end_utc)],
+            period_of = lambda column, utc = False: '{} AS period_rank'.format(
+                period_rank(column, end_bounds, '<') if utc else
+                period_rank(column, [v for _, v in periods])))
+    else:
+        q.update(users = 'campaign_lists', end_date = 'a.end_date',
+            period_col = 'promo_period',
+            ends = [('<=', 'a.end_date')],
+            ends_utc = [('<', 'a.end_before_utc'), ('<', last_end_utc)],
+            period_of = lambda column, utc = False: 'a.promo_period')
+    if batch:
+        q.update(start_date = 'a.start_date', start_utc = 'a.start_after_utc',
+            starts = [('>=', 'a.start_date'), ('>=', start_date)],
+            starts_utc = [('>=', 'a.start_after_utc'), ('>=', start_utc)],
+            ends = [('<=', 'a.end_date'), ('<=', last_end_date)],
+            campaign_of = lambda column: "SPLIT_PART({}, '|', 1)".format(
+                column))
+
+    required = set(name for info in infos for name in required_metrics(info))
+    metrics = [(name, metric) for name, metric in METRICS if name in required]
+    registry = ROLLUP_CTES if rollup else QUERY_CTES
+    ctes = required_ctes([metric['cte'] for _, metric in metrics], registry)
+    for name in ctes:
+        query, measures = registry[name]['build'](q)
+        compose_full_query += metric_ctes(name, query, measures, bucketed)
+    logging.info('Query computes {} from {}'.format(
+        ', '.join(name for name, _ in metrics) or 'no metrics',
+        ', '.join(sorted(set(source for name in ctes
+                             for source in registry[name]['sources'])))
+        or 'the campaign table only'))
+
+    boolean_metrics = []
+    numeric_metrics = []
+    joins = []
+    for name, metric in metrics:
+        for info in infos:
+            booleans, numerics = metric_columns(metric, info)
+            boolean_metrics.extend(col for col in booleans
+                                   if col not in boolean_metrics)
+            numeric_metrics.extend(col for col in numerics
+                                   if col not in numeric_metrics)
+        joins.append((metric['cte'], metric['alias'],
+                      metric.get('per_period', True)))
 
     boolean_metrics_q = [', COALESCE({a}, false) AS {a}'.format(a = x)
         for x in boolean_metrics]
@@ -351,12 +927,14 @@ def build_query(info, test_matrix):
         AND {a}.promo_period = a.promo_period""".format(
             tbl_name = tbl_name,
             a = alias)
-        if tbl_name != 'four_week_order'
+        if per_period
         else """LEFT JOIN {tbl_name} {a}
-        ON {a}.user_id = a.user_id""".format(
+        ON {a}.user_id = a.user_id{campaign}""".format(
             tbl_name = tbl_name,
-            a = alias)
-        for tbl_name, alias in joins]
+            a = alias,
+            campaign = '\n        AND {}.campaign = a.campaign'.format(alias)
+                       if batch else '')
+        for tbl_name, alias, per_period in joins]
 
     individual_metrics = """SELECT a.*
         {boolean_metrics}
@@ -368,7 +946,7 @@ def build_query(info, test_matrix):
         numeric_metrics = '\n    '.join(numeric_metrics_q),
         join_query = '\n    '.join(join_q))
 
-    if info.redeemed_offer_discount:
+    if offer_redeemed:
         boolean_metrics.append('offer_redeemed')
 
     aggregate_boolean = [', SUM( CASE WHEN a.{a} THEN 1 ELSE 0 END) AS {a}'.format(
@@ -376,8 +954,41 @@ def build_query(info, test_matrix):
     aggregate_numeric = [', SUM(a.{a}) AS {a}'.format(
         a = a) for a in numeric_metrics]
 
-    aggregates = """SELECT a.promo_period
-        , '{start_date}' AS start_date
+    # the responder flag comes from the promo period and is looked up once
+    # per user instead of joining individual_metrics to itself
+    if batch:
+        responders = """,
+        responders AS (
+        SELECT DISTINCT user_id
+            , campaign
+            , CASE campaign
+                {} END AS responder
+        FROM individual_metrics
+        WHERE period_name = 'promo_period')""".format(
+            '\n                '.join("WHEN '{}' THEN {}".format(
+                info.campaign_short_name.strip().lower(),
+                'TRUE' if info.responder_action == 1
+                else info.responder_action)
+                for info in infos))
+        responder_join = """INNER JOIN responders r
+        ON a.user_id = r.user_id
+        AND a.campaign = r.campaign"""
+    elif infos[0].responder_action == 1:
+        responders = ''
+        responder_join = ''
+    else:
+        responders = """,
+        responders AS (
+        SELECT DISTINCT user_id
+            , {} AS responder
+        FROM individual_metrics
+        WHERE promo_period = 'promo_period')""".format(
+            infos[0].responder_action)
+        responder_join = """INNER JOIN responders r
+        ON a.user_id = r.user_id"""
+
+    aggregates = """SELECT {campaign}a.{promo_period}
+        , {start_date} AS start_date
         , a.end_date
         , {responder_action} AS responder
         , {test_matrix_cols}
@@ -385,30 +996,93 @@ def build_query(info, test_matrix):
         {agg_bools}
         {agg_nums}
     FROM individual_metrics a
-    INNER JOIN individual_metrics r
-        ON a.user_id = r.user_id
-        AND r.promo_period = 'promo_period'
+    {responder_join}
     GROUP BY {join_nums}
     """.format(
-        start_date = start_date,
-        responder_action = ('TRUE' if info.responder_action == 1
-                                   else 'r.' + info.responder_action),
+        campaign = 'a.campaign\n        , ' if batch else '',
+        promo_period = 'period_name AS promo_period' if batch
+                       else 'promo_period',
+        start_date = q['start_date'],
+        responder_action = ('TRUE' if not responder_join
+                                   else 'r.responder'),
+        responder_join = responder_join,
         test_matrix_cols = '\n    , '.join('a.{}'.format(col) for col in test_matrix.columns),
         agg_bools = '\n    '.join(aggregate_boolean),
         agg_nums = '\n    '.join(aggregate_numeric),
         join_nums = ','.join([str(i+1)
-            for i in range(test_matrix.shape[1]+4)]))
+            for i in range(test_matrix.shape[1] + (5 if batch else 4))]))
 
     compose_full_query += """
         individual_metrics AS (
-        {})
+        {}){}
         {}""".format(
             individual_metrics,
+            responders,
             aggregates)
     return compose_full_query
 
 
-def compute_and_output_metrics(data, info, path, tm_cols):
+# report formats, applied once to the finite values of a column
+FORMATS = {
+    'percent': '{:.2%}'.format,
+    'dollars': '${:,.2f}'.format,
+    'price': '${:.2f}'.format,
+    'average': lambda k: '{}'.format(round(k, 2)),
+}
+
+# derived KPI -> numerator, denominator (None to report the numerator
+# itself) and format
+DERIVED_METRICS = [
+    ('reactivation_rate', 'reactivations', 'segment_responder_size',
+     'percent'),
+    ('activation_rate', 'new_activations', 'segment_responder_size',
+     'percent'),
+    ('cancelation_rate', 'cancelations', 'segment_responder_size',
+     'percent'),
+    ('avg_boxes_ordered', 'total_boxes_ordered', 'segment_responder_size',
+     'average'),
+    ('aov', 'gov', 'total_boxes_ordered', 'price'),
+    ('gov', 'gov', None, 'dollars'),
+    ('dessert_take_rate', 'desserts_ordered', 'total_boxes_ordered',
+     'percent'),
+    ('pct_redeemed', 'redeemed_offer_discount', 'segment_responder_size',
+     'percent'),
+    ('pct_active_at_end', 'total_active_at_end', 'segment_responder_size',
+     'percent'),
+    ('pct_ordered_week_4', 'total_ordered_week_4', 'segment_responder_size',
+     'percent'),
+    ('avg_num_boxes_first_4_weeks', 'num_boxes_first_4_weeks',
+     'segment_responder_size', 'average'),
+]
+
+
+def format_metric(values, fmt):
+    # infinite and missing ratios (empty denominators) are left blank
+    finite = np.isfinite(values.astype(float))
+    formatted = pd.Series('', index = values.index, dtype = object)
+    formatted[finite] = values[finite].map(FORMATS[fmt])
+    return formatted
+
+
+def widen_metrics(data, id_cols, metrics, promo_periods):
+    # one row per id_cols and one column per period and metric, named
+    # 'metric\nperiod' and grouped by period in the order given
+    wide = (data.set_index(id_cols + ['promo_period'])[metrics]
+            .unstack('promo_period'))
+    columns = [(metric, period) for period in promo_periods
+               for metric in metrics]
+    wide = wide.reindex(columns = pd.MultiIndex.from_tuples(columns))
+    wide.columns = ['{}\n{}'.format(metric, period)
+                    for metric, period in columns]
+    return wide
+
+
+def compute_and_output_metrics(data, info, path, tm_cols, frozen = None):
+    if frozen is not None:
+        # rows of periods frozen by earlier runs replace any recomputed ones
+        data = pd.concat([frozen,
+                          data[~data.promo_period.isin(frozen.promo_period)]],
+                         ignore_index = True)
     data = data.rename(columns = {
         'canceled': 'cancelations',
         'activated': 'new_activations',
@@ -424,29 +1098,35 @@ def compute_and_output_metrics(data, info, path, tm_cols):
 
     id_cols = ['target_name', 'responder']
 
-    totals = (data[id_cols + ['segment_responder_size']]
-              .drop_duplicates()
-              .groupby('target_name'))
-    response_rates = {target: df.loc[df.responder == True,
-        'segment_responder_size'] / df.segment_responder_size.sum()
-        for target, df in totals}
-    response_rates = pd.Series(
-        {target: v.iloc[0] if len(v) else 0
-                 for target, v in response_rates.items()},
-        name = 'response_rate')
+    sizes = data[id_cols + ['segment_responder_size']].drop_duplicates()
+    totals = sizes.groupby('target_name', observed = True) \
+        .segment_responder_size.sum()
+    responder_sizes = (sizes[sizes.responder == True]
+        .groupby('target_name', observed = True)
+        .segment_responder_size.first())
+    response_rates = (responder_sizes / totals).reindex(
+        totals.index, fill_value = 0).rename('response_rate')
     data = data.join(response_rates, on = 'target_name')
-    data['response_rate'] = ["{:.2%}".format(k) for k in data.response_rate]
+
+    metrics = list(info.loc['cancelations':][info.astype(bool)].index)
+    for name, numerator, denominator, _ in DERIVED_METRICS:
+        if name in metrics:
+            data[name] = (data[numerator] / data[denominator]
+                          if denominator else data[numerator])
+
+    # every derived metric stays numeric up to here; render the report
+    data['response_rate'] = format_metric(data.response_rate, 'percent')
+    for name, _, _, fmt in DERIVED_METRICS:
+        if name in metrics:
+            data[name] = format_metric(data[name], fmt)
 
     unpivot_cols = [x for x in tm_cols if x != 'target_name']
     unpivot_cols.extend(['segment_responder_size', 'response_rate'])
     tm_data = data[id_cols + unpivot_cols].drop_duplicates()
     tm_data = tm_data.set_index(id_cols)
 
-    data['date_range'] = ['{} - {}'.format(i.start_date.strftime('%m/%d'),
-        i.end_date.strftime('%m/%d'))
-        for i in data.itertuples(index=False)]
-
-    metrics = list(info.loc['cancelations':][info.astype(bool)].index)
+    data['date_range'] = (data.start_date.dt.strftime('%m/%d') + ' - ' +
+                          data.end_date.dt.strftime('%m/%d'))
     metrics.insert(0, 'date_range')
 
     if 'ordered_nth_box' in metrics:
@@ -456,51 +1136,6 @@ def compute_and_output_metrics(data, info, path, tm_cols):
         metrics.remove('ordered_nth_box')
         metrics.extend(boxes_ordered)
 
-    if 'reactivation_rate' in metrics:
-        data['reactivation_rate'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.reactivations / data.segment_responder_size]
-
-    if 'activation_rate' in metrics:
-        data['activation_rate'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.new_activations / data.segment_responder_size]
-
-    if 'cancelation_rate' in metrics:
-        data['cancelation_rate'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.cancelations / data.segment_responder_size]
-
-    if 'avg_boxes_ordered' in metrics:
-        data['avg_boxes_ordered'] = ["{}".format(round(k,2))
-            if np.isfinite(k) else ''
-            for k in data.total_boxes_ordered / data.segment_responder_size]
-
-    if 'aov' in metrics:
-        data['aov'] = ["${:.2f}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.gov / data.total_boxes_ordered]
-
-    if 'gov' in metrics:
-        data['gov'] = ["${:,.2f}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.gov]
-
-    if 'dessert_take_rate' in metrics:
-        data['dessert_take_rate'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.desserts_ordered / data.total_boxes_ordered]
-
-    if 'pct_redeemed' in metrics:
-        data['pct_redeemed'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.redeemed_offer_discount / data.segment_responder_size]
-
-    if 'pct_active_at_end' in metrics:
-        data['pct_active_at_end'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.total_active_at_end / data.segment_responder_size]
-
     if 'ordered_ds' in metrics:
         ds_ordered = [re.match(r'ordered_ds_\d{4,}', col)
             for col in data.columns]
@@ -508,29 +1143,12 @@ def compute_and_output_metrics(data, info, path, tm_cols):
         metrics.remove('ordered_ds')
         metrics.extend(ds_ordered)
 
-    if 'pct_ordered_week_4' in metrics:
-        data['pct_ordered_week_4'] = ["{:.2%}".format(k)
-            if np.isfinite(k) else ''
-            for k in data.total_ordered_week_4 / data.segment_responder_size]
-
-    if 'avg_num_boxes_first_4_weeks' in metrics:
-        data['avg_num_boxes_first_4_weeks'] = ["{}".format(round(k,2))
-            if np.isfinite(k) else ''
-            for k in data.num_boxes_first_4_weeks / data.segment_responder_size]
-
-    data = data[id_cols + ['promo_period'] + metrics]
-    pivot = data.pivot_table(index = id_cols,
-        columns = 'promo_period', aggfunc = lambda x: x)
-
     promo_periods = [i.replace('_end_date', '')
         for i in info.index
         if i.endswith('_end_date') and info.notnull().loc[i]]
 
-    data_wide = [pivot.xs(i, axis = 1, level = 'promo_period')[metrics].rename(
-        columns = lambda x: '{}\n{}'.format(x, i))
-        for i in promo_periods]
-
-    data_wide = tm_data.join(data_wide)
+    data_wide = tm_data.join(widen_metrics(data, id_cols, metrics,
+                                           promo_periods))
     responders = ['responder' if i else 'non-responder'
         for i in data_wide.index.levels[1]]
     data_wide.index = data_wide.index.set_levels(
@@ -560,35 +1178,263 @@ def main(args):
     [logging.info('Input argument {} set to {}'.format(k, v))
         for k,v in vars(args).items()]
 
-    campaign_dir, test_matrix, campaign_info = extract_campaign_info(args)
-    query = build_query(campaign_info, test_matrix)
+    engine = create_redshift_engine()
+    if len(args.campaign_dir) > 1:
+        args.campaign_dirs = args.campaign_dir
+        generate_batch_metrics(args, engine)
+    else:
+        args.campaign_dir = args.campaign_dir[0]
+        generate_metrics(args, engine)
+
+
+def write_query(query, campaign_dir, campaign_info, engine):
     with open(str(Path(campaign_dir, 'generated_query.sql')), 'w') as f:
         f.write(query)
     logging.info('Query generated and written to disk at {}'
                  .format(str(Path(campaign_dir, 'generated_query.sql'))))
 
-    engine = create_engine("{driver}://{host}:{port}/{dbname}".format(
-          driver = "postgresql+psycopg2",
-          host = "localhost",
-          port = 5439,
-          dbname = "production"))
-
     tbl_name = campaign_info.campaign_short_name.strip().lower()
     if not engine.has_table(tbl_name, schema = 'analytics'):
         logging.error('Table `analytics.{}` not found'.format(tbl_name))
     else:
         logging.info('Table `analytics.{}` found successfully'.format(tbl_name))
+    if APP_ACTIVE_DAYS in query:
+        # like the rollup, the index has to be current for the periods or
+        # used_the_app silently undercounts; evening app events of the last
+        # New York day are dated by the next UTC day
+        indexed_through = app_active_days_watermark(engine)
+        _, period_ends = promo_periods_of(campaign_info)
+        needed = min(period_ends.max() + pd.Timedelta(days = 1),
+                     pd.Timestamp.now('UTC').tz_localize(None).normalize())
+        if indexed_through is None:
+            logging.error('Table `{}` not found, run process_campaign.'
+                          'app_activity first'.format(APP_ACTIVE_DAYS))
+        elif indexed_through < needed:
+            logging.error('Table `{}` only indexes app activity through {} '
+                          'but the campaign needs {}, run process_campaign.'
+                          'app_activity first'.format(APP_ACTIVE_DAYS,
+                          indexed_through.date(), needed.date()))
+
+
+def fetch_metrics(query, engine, args, tm_cols):
+    # test matrix columns repeat for every period and responder group
+    categoricals = list(tm_cols) + ['campaign', 'promo_period']
+    parse_dates = ['start_date', 'end_date']
+    if args.unload:
+        return unload_frame(query, engine, args.unload_bucket,
+                            args.unload_s3dir, parse_dates = parse_dates,
+                            categoricals = categoricals)
+    return fetch_frame(text(query), engine, parse_dates = parse_dates,
+                       categoricals = categoricals,
+                       chunksize = args.fetch_chunksize)
+
+
+def fetch_cached_metrics(query, engine, args, campaigns, cache_name):
+    # a rerun whose query and data version match a cached result only asks
+    # Redshift for the data version, not for the query itself; returns the
+    # data and its version, None when the result cache is off
+    if args.no_result_cache:
+        return fetch_metrics(query, engine, args,
+                             campaigns[0][1].columns), None
+    cache = ResultCache(Path(args.result_cache_dir, cache_name),
+                        max_bytes = args.result_cache_max_mb * 2**20)
+    version = data_version(engine, query, campaigns)
+    data = None if version is None else cache.load(query, version)
+    if data is not None:
+        logging.info('Aggregate data read from the result cache {}'
+                     .format(str(cache)))
+        return data, version
+
+    data = fetch_metrics(query, engine, args, campaigns[0][1].columns)
+    if version is not None:
+        cache.store(query, version, data)
+        cache.evict()
+        cache.save()
+    return data, version
+
+
+def freezable_periods(info, watermark, freeze_after_days):
+    # periods with a fixed end date at least freeze_after_days before the
+    # time every source has been loaded up to
+    promo_periods, period_ends = promo_periods_of(info)
+    return [k for k, v in promo_periods.items() if v != 'current_date'
+            and period_ends[k] + pd.Timedelta(days = 1 + freeze_after_days)
+            <= watermark]
+
+
+def fetch_open_periods(query, engine, args, campaign_info, test_matrix,
+                       cache_name):
+    # rows of frozen periods are kept from earlier runs and only the open
+    # periods are queried; returns the open rows and the frozen ones
+    campaigns = [(campaign_info, test_matrix)]
+    promo_periods, _ = promo_periods_of(campaign_info)
+    ongoing = [k for k, v in promo_periods.items() if v == 'current_date']
+    # periods ending on current_date never freeze, and neither does a
+    # campaign whose responder flag is read from an ongoing promo_period
+    version = (None if args.no_frozen_periods
+               or len(ongoing) == len(promo_periods)
+               or ('promo_period' in ongoing
+                   and campaign_info.responder_action != 1)
+               else campaign_version(engine, campaigns))
+    if version is None:
+        data, _ = fetch_cached_metrics(query, engine, args, campaigns,
+                                       cache_name)
+        return data, None
+
+    # frozen rows are keyed by the query of the periods with fixed end
+    # dates, whose text unlike that of the full query does not change
+    # with the date when some period ends on current_date
+    fixed_info = campaign_info.copy()
+    for period in ongoing:
+        fixed_info['{}_end_date'.format(period)] = None
+    fixed_query = (build_query(fixed_info, test_matrix,
+                               bucketed = args.bucketed,
+                               rollup = args.from_rollup)
+                   if ongoing else query)
+
+    store = ResultCache(Path(args.result_cache_dir, 'frozen', cache_name))
+    frozen = store.load(fixed_query, version)
+    frozen_periods = set() if frozen is None else set(frozen.promo_period)
+    open_periods = [k for k in promo_periods.index
+                    if k not in frozen_periods]
+    if not open_periods:
+        logging.info('All periods are frozen, skipping the metrics query')
+        return frozen.iloc[:0], frozen
+
+    open_query = query
+    if frozen_periods:
+        # promo_period stays in the query when the responder flag is read
+        # from it, and its recomputed rows are dropped
+        open_info = campaign_info.copy()
+        for period in frozen_periods:
+            if period != 'promo_period' or campaign_info.responder_action == 1:
+                open_info['{}_end_date'.format(period)] = None
+        open_query = build_query(open_info, test_matrix,
+            bucketed = args.bucketed, rollup = args.from_rollup)
+        logging.info('Periods {} are frozen, querying {}'.format(
+            ', '.join(sorted(frozen_periods)), ', '.join(open_periods)))
+    data, open_version = fetch_cached_metrics(open_query, engine, args,
+                                              campaigns, cache_name)
+    data = data[~data.promo_period.isin(frozen_periods)]
+
+    watermark = load_watermark(open_version or
+                               data_version(engine, open_query, campaigns))
+    newly_frozen = [k for k in freezable_periods(campaign_info, watermark,
+                                                 args.freeze_after_days)
+                    if k in open_periods]
+    if newly_frozen:
+        rows = data[data.promo_period.isin(newly_frozen)]
+        frozen = (rows if frozen is None else
+                  pd.concat([frozen, rows], ignore_index = True))
+        store.store(fixed_query, version, frozen.reset_index(drop = True))
+        store.evict()
+        store.save()
+        logging.info('Froze periods {} ending before the load watermark {}'
+                     .format(', '.join(newly_frozen), watermark))
+    return data, frozen
+
+
+def check_rollup(args, engine):
+    if not args.from_rollup:
+        return
+    refreshed_at = last_daily_facts_refresh(engine)
+    if refreshed_at is None:
+        logging.error('Table {} has never been refreshed, run '
+                      'process_campaign.daily_facts first'.format(DAILY_FACTS))
+    else:
+        logging.info('Reading metrics from {} as of its refresh at {}'
+                     .format(DAILY_FACTS, refreshed_at))
+
+
+def generate_metrics(args, engine):
+    campaign_dir, test_matrix, campaign_info = extract_campaign_info(args)
+    check_rollup(args, engine)
+    query = build_query(campaign_info, test_matrix,
+                        bucketed = args.bucketed, rollup = args.from_rollup)
+    write_query(query, campaign_dir, campaign_info, engine)
 
-    data = pd.read_sql_query(text(query), engine,
-        parse_dates = ['start_date', 'end_date'])
+    data, frozen = fetch_open_periods(query, engine, args, campaign_info,
+        test_matrix, Path(campaign_dir).name)
     logging.info('Aggregate data pulled successfully from analytics.{}'
-                 .format(tbl_name))
+                 .format(campaign_info.campaign_short_name.strip().lower()))
 
     output_file = ('{}_report_metrics.csv'
                    .format(campaign_info.campaign_name.strip()))
     compute_and_output_metrics(data, campaign_info,
                                tm_cols = test_matrix.columns,
-                               path = Path(campaign_dir, output_file))
+                               path = Path(campaign_dir, output_file),
+                               frozen = frozen)
+
+
+def generate_batch_metrics(args, engine):
+    # one query for all of args.campaign_dirs, split into the usual
+    # per-campaign report files
+    campaigns = [extract_campaign_info(Namespace(**dict(vars(args),
+                                                        campaign_dir = c)))
+                 for c in args.campaign_dirs]
+    check_rollup(args, engine)
+    query = build_batch_query([(campaign_info, test_matrix)
+        for _, test_matrix, campaign_info in campaigns],
+        rollup = args.from_rollup)
+    for campaign_dir, _, campaign_info in campaigns:
+        write_query(query, campaign_dir, campaign_info, engine)
+
+    data, _ = fetch_cached_metrics(query, engine, args,
+        [(campaign_info, test_matrix)
+         for _, test_matrix, campaign_info in campaigns], 'batch')
+    logging.info('Aggregate data pulled successfully for {} campaigns'
+                 .format(len(campaigns)))
+
+    # each report only keeps the metric columns of its own template, in
+    # the order its own query would have returned them
+    batch_columns = set(col for _, _, campaign_info in campaigns
+                        for cols in campaign_columns(campaign_info)
+                        for col in cols)
+    for campaign_dir, test_matrix, campaign_info in campaigns:
+        booleans, numerics = campaign_columns(campaign_info)
+        campaign_data = data.loc[data.campaign == campaign_info
+            .campaign_short_name.strip().lower(),
+            [col for col in data.columns
+             if col not in batch_columns and col != 'campaign']
+            + booleans + numerics]
+
+        output_file = ('{}_report_metrics.csv'
+                       .format(campaign_info.campaign_name.strip()))
+        compute_and_output_metrics(campaign_data, campaign_info,
+                                   tm_cols = test_matrix.columns,
+                                   path = Path(campaign_dir, output_file))
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--bucketed', action = 'store_true',
+        help = 'scan each fact table once per user and roll up promo '
+               'periods instead of joining once per period')
+    parser.add_argument('--from_rollup', action = 'store_true',
+        help = 'compute every KPI from the per-user daily fact rollup '
+               'instead of the raw fact tables')
+    parser.add_argument('--fetch_chunksize', type = int, default = 100000,
+        help = 'rows fetched at a time from the server-side cursor')
+    parser.add_argument('--unload', action = 'store_true',
+        help = 'UNLOAD very large results to S3 as parquet and read them '
+               'from there instead of through a cursor')
+    parser.add_argument('--unload_bucket', default = 'plated-redshift-etl',
+        help = 'S3 bucket receiving unloaded results')
+    parser.add_argument('--unload_s3dir', default = 'manual/campaigns_jackie',
+        help = 'S3 directory within bucket receiving unloaded results')
+    parser.add_argument('--result_cache_dir',
+        help = 'local directory caching metrics query results',
+        default = str(Path(Path.home(), '.campaign_cache', 'results')))
+    parser.add_argument('--no_result_cache', action = 'store_true',
+        help = 'always run the metrics query instead of using cached '
+               'results')
+    parser.add_argument('--result_cache_max_mb', type = int, default = 512,
+        help = 'maximum size of the result cache per campaign')
+    parser.add_argument('--no_frozen_periods', action = 'store_true',
+        help = 'recompute every period instead of reusing the stored '
+               'results of periods that have ended')
+    parser.add_argument('--freeze_after_days', type = int, default = 7,
+        help = 'days a period must have ended before the warehouse load '
+               'watermark for its results to be frozen')
 
 
 if __name__ == '__main__':
@@ -598,7 +1444,12 @@ if __name__ == '__main__':
         default = str(Path(Path.home(),
             'Google Drive File Stream', 'My Drive',
             'Reformatted Prioritized Campaign Lists')))
-    parser.add_argument('campaign_dir',
-        help = 'name of directory for desired campaign')
+    parser.add_argument('campaign_dir', nargs = '+',
+        help = 'names of directories for the desired campaigns, computed '
+               'together in one batched query when more than one is given')
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    if args.bucketed and len(args.campaign_dir) > 1:
+        parser.error('--bucketed cannot be combined with a batch of '
+                     'campaigns')
     main(args)
@@ -0,0 +1,119 @@
+import logging, sqlite3, time
+from pathlib import Path
+import pandas as pd
+from .fetch import fetch_chunks
+
+# send list id column -> dw.users column it is resolved against
+ID_COLUMNS = [('prospect_id', 'internal_marketing_prospect_id'),
+              ('external_id', 'external_id'),
+              ('email', 'email')]
+
+
+def normalize_ids(values):
+    # ids are stored as text; whole floats (ids read next to blanks) lose
+    # their trailing .0 so they match the warehouse values
+    return values.map(lambda v: str(int(v))
+        if isinstance(v, float) and v.is_integer() else str(v))
+
+
+class IdentityCache:
+    # local sqlite copy of email/prospect_id/external_id -> internal_user_id
+    # mappings from dw.users, refreshed incrementally by updated_at and
+    # rebuilt from scratch once the last full load is older than ttl_days
+
+    def __init__(self, path, ttl_days = 7):
+        Path(path).parent.mkdir(parents = True, exist_ok = True)
+        self.connection = sqlite3.connect(str(path), timeout = 60,
+                                          check_same_thread = False)
+        self.ttl_days = ttl_days
+        self.hits = 0
+        self.misses = 0
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS identities (
+                id_type TEXT NOT NULL,
+                id_value TEXT NOT NULL,
+                internal_user_id INTEGER NOT NULL,
+                PRIMARY KEY (id_type, id_value))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS refreshes (
+                name TEXT PRIMARY KEY,
+                value TEXT)""")
+
+    def __str__(self):
+        return '(hits: {}, misses: {})'.format(self.hits, self.misses)
+
+    def get_state(self, name):
+        row = self.connection.execute(
+            'SELECT value FROM refreshes WHERE name = ?', (name,)).fetchone()
+        return row and row[0]
+
+    def set_state(self, name, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (name, value))
+
+    def refresh(self, engine, chunksize = 200000):
+        full_refresh_at = self.get_state('full_refresh_at')
+        expired = (full_refresh_at is None or
+            time.time() - float(full_refresh_at) > self.ttl_days * 86400)
+        watermark = None if expired else self.get_state('updated_at')
+
+        query = """SELECT internal_user_id
+            , internal_marketing_prospect_id
+            , external_id
+            , email
+            , updated_at
+        FROM dw.users
+        WHERE internal_user_id IS NOT NULL
+        {}""".format("AND updated_at > '{}'".format(watermark)
+                     if watermark else '')
+
+        n_rows = 0
+        with self.connection:
+            if expired:
+                self.connection.execute('DELETE FROM identities')
+            for chunk in fetch_chunks(query, engine, chunksize = chunksize):
+                for id_type, users_col in ID_COLUMNS:
+                    ids = chunk[[users_col, 'internal_user_id']].dropna()
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO identities VALUES (?, ?, ?)',
+                        zip([id_type] * len(ids),
+                            normalize_ids(ids[users_col]),
+                            ids.internal_user_id.astype(int).tolist()))
+                if len(chunk):
+                    latest = str(chunk.updated_at.max())
+                    watermark = max(watermark or latest, latest)
+                n_rows += len(chunk)
+
+            if watermark:
+                self.set_state('updated_at', watermark)
+            if expired:
+                self.set_state('full_refresh_at', str(time.time()))
+        logging.info('Identity cache {} refreshed with {} rows from dw.users'
+                     .format('fully' if expired else 'incrementally', n_rows))
+
+    def lookup(self, id_type, values, batch_size = 500):
+        normalized = normalize_ids(values.dropna())
+        keys = normalized.unique().tolist()
+        found = {}
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            found.update(self.connection.execute(
+                """SELECT id_value, internal_user_id FROM identities
+                WHERE id_type = ? AND id_value IN ({})""".format(
+                    ', '.join('?' * len(batch))),
+                [id_type] + batch).fetchall())
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        user_ids = pd.Series(float('nan'), index = values.index)
+        user_ids[values.notnull().values] = normalized.map(found).values
+        return user_ids
+
+    def attach_user_ids(self, data):
+        id_col = next((col for col, _ in ID_COLUMNS if col in data.columns),
+                      None)
+        if 'user_id' in data.columns or id_col is None:
+            return data
+
+        data['user_id'] = self.lookup(id_col, data[id_col])
+        logging.info('Identity cache resolved {} of {} rows by {} {}'.format(
+            data.user_id.notnull().sum(), len(data), id_col, str(self)))
+        return data
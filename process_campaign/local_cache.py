@@ -0,0 +1,194 @@
+import hashlib, json, logging, os, threading, time
+from pathlib import Path
+import pandas as pd
+
+try:
+    import pyarrow
+    FRAME_FORMAT = 'parquet'
+except ImportError:
+    FRAME_FORMAT = 'pickle'
+
+# bump whenever the normalization applied before caching changes so that
+# frames written by older code are never read back
+NORMALIZATION_VERSION = 1
+
+
+def file_digest(path, block_size = 2**20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class LocalCache:
+    # DataFrames stored on local disk, tracked by a JSON manifest and
+    # evicted by age and then least-recent use once over max_bytes
+
+    def __init__(self, cache_dir, max_bytes = 2 * 2**30, max_age_days = 90):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        self.manifest_path = Path(self.cache_dir, 'manifest.json')
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(str(self.manifest_path)) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            self.manifest = {}
+        self.manifest.setdefault('entries', {})
+
+    def __str__(self):
+        return '(cache_dir: {}, entries: {}, hits: {}, misses: {})'.format(
+            self.cache_dir, len(self.manifest['entries']),
+            self.hits, self.misses)
+
+    def get_frame(self, key):
+        with self.lock:
+            entry = self.manifest['entries'].get(key)
+        path = entry and Path(self.cache_dir, entry['file'])
+        if entry is None or not path.exists():
+            with self.lock:
+                self.misses += 1
+            return None
+
+        if entry['format'] == 'parquet':
+            frame = pd.read_parquet(str(path))
+        else:
+            frame = pd.read_pickle(str(path))
+        with self.lock:
+            entry['accessed'] = time.time()
+            self.hits += 1
+        return frame
+
+    def put_frame(self, key, frame, **metadata):
+        # a frame that cannot be cached is only logged, the caller already
+        # has the result
+        filename = '{}.{}'.format(key, FRAME_FORMAT)
+        path = Path(self.cache_dir, filename)
+        try:
+            if FRAME_FORMAT == 'parquet':
+                frame.to_parquet(str(path), index = False)
+            else:
+                frame.to_pickle(str(path))
+            size = path.stat().st_size
+        except Exception:
+            logging.warning('Could not cache {} in {}'.format(
+                metadata.get('path', key), self.cache_dir), exc_info = True)
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return
+        now = time.time()
+        metadata.update(file = filename, format = FRAME_FORMAT,
+                        bytes = size, created = now, accessed = now)
+        with self.lock:
+            self.manifest['entries'][key] = metadata
+
+    def evict(self):
+        with self.lock:
+            entries = self.manifest['entries']
+            cutoff = time.time() - self.max_age_days * 86400
+            expired = [k for k, e in entries.items() if e['accessed'] < cutoff]
+
+            by_recency = sorted((k for k in entries if k not in expired),
+                                key = lambda k: entries[k]['accessed'],
+                                reverse = True)
+            total, oversized = 0, []
+            for key in by_recency:
+                total += entries[key]['bytes']
+                if total > self.max_bytes:
+                    oversized.append(key)
+
+            for key in expired + oversized:
+                entry = entries.pop(key)
+                try:
+                    Path(self.cache_dir, entry['file']).unlink()
+                except OSError:
+                    pass
+        if expired or oversized:
+            logging.info('Evicted {} expired and {} least recently used '
+                         'entries from {}'.format(len(expired),
+                         len(oversized), self.cache_dir))
+
+    def save(self):
+        tmp_path = Path(self.cache_dir, 'manifest.json.tmp')
+        with self.lock:
+            with open(str(tmp_path), 'w') as f:
+                json.dump(self.manifest, f)
+        os.replace(str(tmp_path), str(self.manifest_path))
+
+
+class SendListCache(LocalCache):
+    # normalized id columns of each send list, keyed by content hash;
+    # path, size and mtime let unchanged files skip hashing entirely
+
+    def __init__(self, cache_dir, **kwargs):
+        super().__init__(cache_dir, **kwargs)
+        self.manifest.setdefault('files', {})
+
+    def digest(self, path):
+        self.file_key(path)
+        with self.lock:
+            return self.manifest['files'][path]['sha1']
+
+    def file_key(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            record = self.manifest['files'].get(path)
+        if (record is None or record['size'] != stat.st_size
+                or record['mtime_ns'] != stat.st_mtime_ns):
+            # the encoding recorded for a path only holds while its
+            # content is unchanged, a rewritten export is detected again
+            sha1 = file_digest(path)
+            record = {'size': stat.st_size,
+                      'mtime_ns': stat.st_mtime_ns,
+                      'sha1': sha1,
+                      'encoding': record.get('encoding')
+                          if record and record['sha1'] == sha1 else None}
+            with self.lock:
+                self.manifest['files'][path] = record
+        with self.lock:
+            record['accessed'] = time.time()
+        return '{}-v{}'.format(record['sha1'], NORMALIZATION_VERSION)
+
+    def evict(self):
+        super().evict()
+        # records of files that are gone or were not looked at for
+        # max_age_days are dropped with the frames
+        cutoff = time.time() - self.max_age_days * 86400
+        with self.lock:
+            files = self.manifest['files']
+            stale = [path for path, record in files.items()
+                     if record.get('accessed', 0) < cutoff
+                     or not os.path.exists(path)]
+            for path in stale:
+                del files[path]
+        if stale:
+            logging.info('Evicted {} file records from {}'.format(
+                len(stale), self.cache_dir))
+
+    def load(self, path):
+        return self.get_frame(self.file_key(path))
+
+    def encoding(self, path):
+        # only while the file is unchanged since its record was made, so a
+        # streaming read that never hashes it gets no stale encoding
+        stat = os.stat(path)
+        with self.lock:
+            record = self.manifest['files'].get(path, {})
+        if (record.get('size') != stat.st_size
+                or record.get('mtime_ns') != stat.st_mtime_ns):
+            return None
+        return record.get('encoding')
+
+    def store(self, path, frame, encoding = None):
+        key = self.file_key(path)
+        if encoding is not None:
+            with self.lock:
+                self.manifest['files'][path]['encoding'] = encoding
+        self.put_frame(key, frame, path = path)
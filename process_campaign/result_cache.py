@@ -0,0 +1,97 @@
+import hashlib, json
+import pandas as pd
+from .local_cache import LocalCache
+from .daily_facts import DAILY_FACTS, DAILY_FACTS_REFRESHES
+from .app_activity import APP_ACTIVE_DAYS
+
+# source table read by metrics queries -> table and column whose maximum,
+# with the row count, tracks how far it has been loaded. Tables whose rows
+# are updated in place (box statuses, discount redemptions) are versioned
+# by when a row was last updated rather than by the dates they report
+SOURCE_VERSIONS = {
+    'web.user_membership_status_changes': (
+        'web.user_membership_status_changes', 'created_at'),
+    'dw.menu_order_boxes': ('dw.menu_order_boxes', 'updated_at'),
+    'dw.web_track_events': ('dw.web_track_events', 'client_timestamp'),
+    'dw.gift_card_orders': ('dw.gift_card_orders',
+                            'gift_card_order_placed_at'),
+    'dw.user_referral_invites': ('dw.user_referral_invites', 'sent_at'),
+    'dw.marketing_offers': ('dw.marketing_offers', 'offer_redeemed_at'),
+    'dw.marketing_discount_redemptions': (
+        'dw.marketing_discount_redemptions', 'updated_at'),
+    'web.users_discounts': ('web.users_discounts', 'updated_at'),
+    APP_ACTIVE_DAYS: (APP_ACTIVE_DAYS, 'first_seen'),
+    DAILY_FACTS: (DAILY_FACTS_REFRESHES, 'refreshed_at'),
+}
+# updated only when a discount is used, so their latest update says nothing
+# about how far they have been loaded
+UNDATED_SOURCES = ['dw.marketing_discount_redemptions', 'web.users_discounts']
+
+
+def campaign_version(engine, campaigns):
+    # when each campaign table was last loaded and its test matrix; None if
+    # a campaign table has no load ledger to date it by
+    version = {}
+    for info, test_matrix in campaigns:
+        tbl_name = info.campaign_short_name.strip().lower()
+        if not engine.has_table('{}_loaded_files'.format(tbl_name),
+                                schema = 'analytics'):
+            return None
+        with engine.begin() as connection:
+            loaded_at = connection.execute(
+                'SELECT max(loaded_at) FROM analytics.{}_loaded_files'
+                .format(tbl_name)).scalar()
+        version[tbl_name] = [str(loaded_at),
+                             test_matrix.to_csv(index = False)]
+    return version
+
+
+def data_version(engine, query, campaigns):
+    # what the result of query depends on besides its text: the campaign
+    # version, how far every source was loaded and, for periods ending on
+    # current_date, the date
+    version = campaign_version(engine, campaigns)
+    if version is None:
+        return None
+
+    sources = [(table, column) for source, (table, column)
+               in sorted(SOURCE_VERSIONS.items()) if source in query]
+    if sources:
+        with engine.begin() as connection:
+            for table, n_rows, loaded_through in connection.execute(
+                    '\nUNION ALL\n'.join("""SELECT '{table}', COUNT(*),
+                    CAST(max({column}) AS VARCHAR) FROM {table}""".format(
+                        table = table, column = column)
+                    for table, column in sources)):
+                version[table] = [n_rows, loaded_through]
+
+    if 'current_date' in query:
+        version['current_date'] = str(
+            pd.Timestamp.now('UTC').tz_localize(None).date())
+    return version
+
+
+def load_watermark(version):
+    # the time up to which every source in version has been loaded, the
+    # earliest of them
+    versioned = set(table for table, _ in SOURCE_VERSIONS.values()
+                    if table not in UNDATED_SOURCES)
+    loaded = [pd.Timestamp(version[table][1]) for table in versioned
+              if table in version and version[table][1] is not None]
+    return min(loaded + [pd.Timestamp.now('UTC').tz_localize(None)])
+
+
+class ResultCache(LocalCache):
+    # aggregate results of metrics queries, keyed by the query text and the
+    # data_version of everything it reads
+
+    def key(self, query, version):
+        digest = hashlib.sha1(query.encode('utf-8'))
+        digest.update(json.dumps(version, sort_keys = True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def load(self, query, version):
+        return self.get_frame(self.key(query, version))
+
+    def store(self, query, version, frame):
+        self.put_frame(self.key(query, version), frame)
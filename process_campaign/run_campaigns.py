@@ -0,0 +1,217 @@
+import contextvars, logging, sys, threading, time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from pathlib import Path
+from process_campaign.upload_redshift import (upload_campaign,
+    create_redshift_engine, add_upload_arguments, refresh_identity_cache)
+from process_campaign.generate_sql_query import (generate_metrics,
+    generate_batch_metrics, add_metrics_arguments)
+
+# each campaign runs these steps in order; a step only starts once the
+# previous step for the same campaign has succeeded
+STEPS = [('upload', upload_campaign),
+         ('metrics', generate_metrics)]
+
+
+# step and campaign the current context is running; nested thread pools
+# submit their work in a copy of the submitting context, so records from
+# their workers carry the campaign too
+CURRENT_STEP = contextvars.ContextVar('current_step', default = None)
+
+
+class CampaignFilter(logging.Filter):
+    # keep only records emitted while running this step, by its own worker
+    # thread or the threads it started
+    def __init__(self, step_name):
+        super().__init__()
+        self.step_name = step_name
+
+    def filter(self, record):
+        return CURRENT_STEP.get() == self.step_name
+
+
+def campaign_log_handlers(step, campaign, today, log_dir):
+    step_filter = CampaignFilter('{}:{}'.format(step, campaign))
+    formatter = logging.Formatter(
+        fmt = '{asctime} {name:12s} {levelname:8s} {message}',
+        datefmt = '%m-%d %H:%M:%S',
+        style = '{')
+
+    handlers = []
+    try:
+        for subdir, suffix, level in [('output_logs', 'out', logging.INFO),
+                                      ('error_logs', 'err', logging.ERROR)]:
+            handler = logging.FileHandler(str(Path(log_dir, subdir,
+                '{}_{}_{}.{}'.format(step, campaign, today, suffix))))
+            handler.setLevel(level)
+            handler.addFilter(step_filter)
+            handler.setFormatter(formatter)
+            handlers.append(handler)
+    except Exception:
+        [handler.close() for handler in handlers]
+        raise
+    return handlers
+
+
+def run_step(step, campaign, engine, args, today, step_fn = None):
+    step_fn = step_fn or dict(STEPS)[step]
+    campaign_args = Namespace(**vars(args))
+    campaign_args.campaign_dir = campaign
+
+    thread = threading.current_thread()
+    pool_name, thread.name = thread.name, '{}:{}'.format(step, campaign)
+    token = CURRENT_STEP.set(thread.name)
+    root = logging.getLogger()
+    handlers = []
+
+    try:
+        try:
+            handlers = campaign_log_handlers(step, campaign, today,
+                                             args.log_dir)
+        except Exception:
+            # logs that cannot be opened fail this step, not the others
+            logging.exception('Could not open log files for {} {}'.format(
+                step, campaign))
+            return False
+        [root.addHandler(handler) for handler in handlers]
+
+        [logging.info('Input argument {} set to {}'.format(k, v))
+            for k,v in vars(campaign_args).items()]
+        for attempt in range(1, args.retries + 2):
+            try:
+                step_fn(campaign_args, engine)
+                return True
+            except Exception:
+                logging.exception('Attempt {} of {} failed for {} {}'.format(
+                    attempt, args.retries + 1, step, campaign))
+                if attempt <= args.retries:
+                    time.sleep(args.retry_delay * attempt)
+        return False
+    finally:
+        [root.removeHandler(handler) for handler in handlers]
+        [handler.close() for handler in handlers]
+        CURRENT_STEP.reset(token)
+        thread.name = pool_name
+
+
+def run_pipeline(campaigns, steps, engine, args):
+    today = datetime.today().strftime('%m_%d_%y')
+    status = {campaign: {step: 'pending' for step in steps}
+              for campaign in campaigns}
+
+    with ThreadPoolExecutor(max_workers = args.max_workers) as executor:
+        running = {executor.submit(run_step, steps[0], campaign,
+                                   engine, args, today): (campaign, 0)
+                   for campaign in campaigns}
+        while running:
+            done, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                campaign, i = running.pop(future)
+                succeeded = future.result()
+                status[campaign][steps[i]] = ('succeeded' if succeeded
+                                              else 'failed')
+                logging.info('{} {} {}'.format(
+                    steps[i], status[campaign][steps[i]], campaign))
+
+                if succeeded and i + 1 < len(steps):
+                    running[executor.submit(run_step, steps[i + 1],
+                        campaign, engine, args, today)] = (campaign, i + 1)
+                elif not succeeded:
+                    for step in steps[i + 1:]:
+                        status[campaign][step] = 'skipped'
+                        logging.error('{} skipped for {} after {} failed'
+                                      .format(step, campaign, steps[i]))
+    return status
+
+
+def run_batch_metrics(campaigns, engine, args, today):
+    # one metrics query shared by every campaign whose earlier steps passed
+    batch_args = Namespace(**vars(args))
+    batch_args.campaign_dirs = campaigns
+    return run_step('metrics', 'batch', engine, batch_args, today,
+                    step_fn = generate_batch_metrics)
+
+
+def main(args):
+    logging.basicConfig(
+        level=logging.INFO,
+        format = '{asctime} {threadName:24s} {levelname:8s} {message}',
+        datefmt = '%m-%d %H:%M:%S',
+        style = '{',
+        stream=sys.stdout)
+
+    [logging.info('Input argument {} set to {}'.format(k, v))
+        for k,v in vars(args).items()]
+
+    for subdir in ('output_logs', 'error_logs'):
+        Path(args.log_dir, subdir).mkdir(parents = True, exist_ok = True)
+
+    # a single engine shares its connection pool across all workers
+    engine = create_redshift_engine(pool_size = args.max_workers)
+    try:
+        steps = [step for step, _ in STEPS if step in args.steps]
+        if 'upload' in steps:
+            refresh_identity_cache(args, engine)
+        batch_metrics = args.batch_metrics and 'metrics' in steps
+        if batch_metrics:
+            steps.remove('metrics')
+        status = (run_pipeline(args.campaigns, steps, engine, args) if steps
+                  else {campaign: {} for campaign in args.campaigns})
+
+        if batch_metrics:
+            ready = [campaign for campaign, steps_run in status.items()
+                     if all(s == 'succeeded' for s in steps_run.values())]
+            succeeded = ready and run_batch_metrics(ready, engine, args,
+                datetime.today().strftime('%m_%d_%y'))
+            for campaign, steps_run in status.items():
+                steps_run['metrics'] = ('skipped' if campaign not in ready
+                                        else 'succeeded' if succeeded
+                                        else 'failed')
+    finally:
+        engine.dispose()
+
+    failed = [campaign for campaign, steps_run in status.items()
+              if any(s != 'succeeded' for s in steps_run.values())]
+    for campaign, steps_run in status.items():
+        logging.info('{}: {}'.format(campaign, ', '.join(
+            '{} {}'.format(step, s) for step, s in steps_run.items())))
+    if failed:
+        logging.error('{} of {} campaigns did not complete: {}'.format(
+            len(failed), len(status), ', '.join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Upload and compute metrics for campaigns.')
+    parser.add_argument('campaigns', nargs = '+',
+        help = 'names of directories for the desired campaigns')
+    parser.add_argument('--root_dir',
+        help = 'path to directory containing information on all campaigns',
+        default = str(Path(Path.home(),
+            'Google Drive File Stream', 'My Drive',
+            'Reformatted Prioritized Campaign Lists')))
+    add_upload_arguments(parser)
+    add_metrics_arguments(parser)
+    parser.add_argument('--steps', nargs = '+',
+        choices = [step for step, _ in STEPS],
+        default = [step for step, _ in STEPS],
+        help = 'pipeline steps to run for each campaign')
+    parser.add_argument('--batch_metrics', action = 'store_true',
+        help = 'compute metrics for all campaigns in one batched query '
+               'once their uploads finish')
+    parser.add_argument('--max_workers', type = int, default = 4,
+        help = 'maximum number of campaign steps running concurrently')
+    parser.add_argument('--retries', type = int, default = 1,
+        help = 'number of times to retry a failed step')
+    parser.add_argument('--retry_delay', type = float, default = 30,
+        help = 'seconds to wait before retrying, multiplied by attempt')
+    parser.add_argument('--log_dir', default = '.',
+        help = 'directory containing output_logs and error_logs')
+    args = parser.parse_args()
+    if args.bucketed and args.batch_metrics:
+        parser.error('--bucketed cannot be combined with --batch_metrics')
+    if args.streaming and args.staging_format == 'parquet':
+        parser.error('--streaming stages send lists as csv and cannot be '
+                     'combined with --staging_format parquet')
+    main(args)
@@ -1,7 +1,8 @@
 from io import BytesIO, StringIO
 import pandas as pd
 import boto3
-import os, logging
+import os, json, logging, threading, zlib, contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 
 class S3ReadWrite:
@@ -79,16 +80,111 @@ class S3ReadWrite:
             self,
             csv_path,
             csv_name,
-            dataframe):
-        csv_buffer = StringIO()
-        dataframe.to_csv(csv_buffer, index=False, header=True)
-        self.resource.Bucket(
-            self.bucket).put_object(
-            Key= '{folder}/{csv_path}/{csv_name}.csv'.format(
-                folder = self.folder,
-                csv_path = csv_path,
-                csv_name = csv_name),
-            Body=csv_buffer.getvalue())
+            dataframe,
+            chunksize = 100000,
+            **upload_kwargs):
+        # streamed a slice at a time as gzipped CSV, so no full CSV copy
+        # of the frame is held in memory
+        key = '{folder}/{csv_path}/{csv_name}.csv.gz'.format(
+            folder = self.folder,
+            csv_path = csv_path,
+            csv_name = csv_name)
+        chunks = (dataframe.iloc[i:i + chunksize]
+                  for i in range(0, max(len(dataframe), 1), chunksize))
+        self.stream_csv_to_S3(key, chunks, **upload_kwargs)
+        return key
+
+    def stream_csv_to_S3(
+            self,
+            key,
+            chunks,
+            part_size = 8 * 2**20,
+            max_concurrency = 4):
+        # encode DataFrame chunks as CSV, gzip them on the fly and upload
+        # parts concurrently; at most max_concurrency parts are in flight,
+        # so memory is bounded by part size rather than by row count
+        upload_id = self.client.create_multipart_upload(
+            Bucket = self.bucket, Key = key,
+            ContentType = 'text/csv',
+            ContentEncoding = 'gzip')['UploadId']
+        compressor = zlib.compressobj(wbits = 16 + zlib.MAX_WBITS)
+        slots = threading.BoundedSemaphore(max_concurrency)
+        content_length = 0
+
+        def upload_part(part_number, body):
+            try:
+                response = self.client.upload_part(
+                    Bucket = self.bucket, Key = key,
+                    PartNumber = part_number, UploadId = upload_id,
+                    Body = body)
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers = max_concurrency) as executor:
+                parts, buffer = [], bytearray()
+
+                def submit(body):
+                    nonlocal content_length
+                    content_length += len(body)
+                    slots.acquire()
+                    parts.append(executor.submit(
+                        contextvars.copy_context().run,
+                        upload_part, len(parts) + 1, bytes(body)))
+
+                for i, chunk in enumerate(chunks):
+                    text = chunk.to_csv(index = False, header = (i == 0))
+                    buffer += compressor.compress(text.encode('utf-8'))
+                    if len(buffer) >= part_size:
+                        submit(buffer)
+                        buffer = bytearray()
+                buffer += compressor.flush()
+                submit(buffer)
+                parts = [part.result() for part in parts]
+
+            self.client.complete_multipart_upload(
+                Bucket = self.bucket, Key = key, UploadId = upload_id,
+                MultipartUpload = {'Parts': parts})
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket = self.bucket, Key = key, UploadId = upload_id)
+            raise
+        logging.info('Streamed {} parts to s3://{}/{}'.format(
+            len(parts), self.bucket, key))
+        return content_length
+
+    def put_dataframe_to_S3_parquet(self, key, dataframe):
+        parquet_buffer = BytesIO()
+        dataframe.to_parquet(parquet_buffer, index = False)
+        self.client.put_object(Bucket = self.bucket, Key = key,
+                               Body = parquet_buffer.getvalue())
+        return parquet_buffer.tell()
+
+    def read_parquet_parts_from_S3(self, prefix):
+        # one DataFrame per object under prefix, read one at a time
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket = self.bucket, Prefix = prefix):
+            for entry in page.get('Contents', []):
+                body = self.client.get_object(Bucket = self.bucket,
+                    Key = entry['Key'])['Body'].read()
+                yield pd.read_parquet(BytesIO(body))
+
+    def delete_prefix_from_S3(self, prefix):
+        self.resource.Bucket(self.bucket).objects.filter(
+            Prefix = prefix).delete()
+
+    def put_manifest_to_S3(self, key, entries):
+        # entries are (key, content_length) pairs; content_length is
+        # required by COPY for columnar formats
+        manifest = {'entries': [
+            {'url': 's3://{}/{}'.format(self.bucket, entry_key),
+             'mandatory': True,
+             'meta': {'content_length': content_length}}
+            for entry_key, content_length in entries]}
+        self.client.put_object(Bucket = self.bucket, Key = key,
+                               Body = json.dumps(manifest, indent = 2))
+        return key
 
     def put_to_S3(self, key, body):
         self.resource.Bucket(
@@ -0,0 +1,69 @@
+import os, logging
+from pathlib import Path
+
+LIST_EXTENSIONS = ('.csv', '.xls', '.xlsx')
+# files written alongside the send lists that are never send lists
+EXCLUDED_SUFFIXES = ('_template.csv', '_template.xlsx',
+                     '_report_metrics.csv')
+
+
+def scan_list_files(campaign_dir):
+    # walk the campaign tree exactly once, keeping candidate list files
+    list_files = []
+    for root, _, filenames in os.walk(str(campaign_dir)):
+        list_files.extend(str(Path(root, filename))
+            for filename in filenames
+            if filename.endswith(LIST_EXTENSIONS)
+            and not filename.endswith(EXCLUDED_SUFFIXES)
+            and not filename.startswith(('.', '~$')))
+    return sorted(list_files)
+
+
+def build_prefix_index(target_names):
+    # character trie of target names; the None key marks a complete name
+    index = {}
+    for target in target_names:
+        node = index
+        for char in target:
+            node = node.setdefault(char, {})
+        node[None] = target
+    return index
+
+
+def match_target(filename, index):
+    # longest target name that is a prefix of filename, or None
+    node, match = index, None
+    for char in filename:
+        node = node.get(char)
+        if node is None:
+            break
+        match = node.get(None, match)
+    return match
+
+
+def index_send_lists(campaign_dir, target_names):
+    target_names = [str(target) for target in target_names
+                    if isinstance(target, str) or target == target]
+    index = build_prefix_index(target_names)
+    list_files = scan_list_files(campaign_dir)
+    logging.info('{} files found'.format(len(list_files)))
+
+    targets_by_file = {}
+    unmatched_files = []
+    for path in list_files:
+        target = match_target(Path(path).name, index)
+        if target is None:
+            unmatched_files.append(path)
+        else:
+            targets_by_file[path] = target
+
+    matched_targets = set(targets_by_file.values())
+    missing_targets = [target for target in target_names
+                       if target not in matched_targets]
+
+    [logging.warning('No target_name matches file {}'.format(path))
+        for path in unmatched_files]
+    [logging.warning('No send list files found for target_name {}'
+                     .format(target))
+        for target in missing_targets]
+    return targets_by_file, unmatched_files, missing_targets
@@ -0,0 +1,31 @@
+import codecs
+
+# longest first: the UTF-32 LE mark begins with the UTF-16 LE mark
+BYTE_ORDER_MARKS = [(codecs.BOM_UTF32_LE, 'utf-32'),
+                    (codecs.BOM_UTF32_BE, 'utf-32'),
+                    (codecs.BOM_UTF8, 'utf-8-sig'),
+                    (codecs.BOM_UTF16_LE, 'utf-16'),
+                    (codecs.BOM_UTF16_BE, 'utf-16')]
+
+# tried in order on the sample; iso-8859-1 decodes any byte sequence
+CANDIDATE_ENCODINGS = ['utf-8', 'cp1252', 'iso-8859-1']
+
+
+def detect_encoding(path, sample_size = 4 * 2**20):
+    with open(path, 'rb') as f:
+        sample = f.read(sample_size)
+
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if sample.startswith(bom):
+            return encoding
+
+    # a truncated sample may end partway through a multi-byte character,
+    # which the incremental decoder holds back instead of rejecting
+    complete = len(sample) < sample_size
+    for encoding in CANDIDATE_ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(
+                sample, final = complete)
+            return encoding
+        except UnicodeDecodeError:
+            continue
@@ -1,100 +1,486 @@
 import boto3
 import pandas as pd
-import sys
+import os, sys, shutil, multiprocessing, contextvars
 from pathlib import Path
 from io import StringIO
 from sqlalchemy import create_engine, text
-from pandas.io.sql import get_schema
 import logging
-from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from argparse import ArgumentParser, Namespace
+from tempfile import TemporaryDirectory
+from contextlib import nullcontext
 from .s3_read_write import S3ReadWrite
-
-
-def process_send_lists(campaign_dir, test_matrix):
-    # Search recursively for all files ending in *.csv, *.xls, *.xlsx
-    all_files = [str(file) for file in
-        list(campaign_dir.glob('**/Send Lists/**/*.csv')) +
-        list(campaign_dir.glob('**/Send Lists/**/*.xlsx'))]
-    logging.info('{} files found'.format(len(all_files)))
-
-    targets_by_file = {str(f): target_name
-        for target_name in test_matrix.target_name
-        for f in campaign_dir.glob('**/{}*'.format(target_name))}
-
-    data = pd.concat([process_single_file(f, target)
-        for f, target in targets_by_file.items()])
-
-    data = (data.rename(columns = {'internal_user_id': 'user_id',
-                                  'email_address': 'email'})
-                .dropna(axis=1, how='all')
-                .merge(test_matrix, on = 'target_name'))
+from .send_list_index import index_send_lists
+from .local_cache import SendListCache, file_digest
+from .identity_cache import IdentityCache, ID_COLUMNS, normalize_ids
+from .text_encoding import detect_encoding
+
+try:
+    import pyarrow
+    STRING_DTYPE = 'string[pyarrow]'
+except ImportError:
+    STRING_DTYPE = 'string'
+
+SEND_LIST_ID_COLUMNS = ['user_id', 'internal_user_id', 'prospect_id',
+                        'email', 'email_address']
+# widths of the text columns of campaign tables, wide enough for any value
+VARCHAR_WIDTHS = {'email': 256, 'external_id': 256, 'target_name': 256}
+
+
+def process_send_lists(campaign_dir, test_matrix, cache = None,
+                       max_workers = 4, identity_cache = None,
+                       targets_by_file = None):
+    # one scan of the campaign tree, each file matched to its target_name
+    if targets_by_file is None:
+        targets_by_file, _, _ = index_send_lists(campaign_dir,
+                                                 test_matrix.target_name)
+
+    failed = []
+    frames = list(parse_send_lists(targets_by_file, cache = cache,
+        max_workers = max_workers, failed = failed))
+    if cache is not None:
+        logging.info('Send list cache {}'.format(str(cache)))
+    # a partial campaign table would replace the live one, so every file
+    # has to parse before anything is uploaded
+    if failed:
+        raise ValueError('{} of {} send lists could not be processed: {}'
+            .format(len(failed), len(targets_by_file), ', '.join(failed)))
+    if not frames:
+        raise ValueError('No send lists found in {}'.format(campaign_dir))
+    data = pd.concat(frames)
+
+    # the test matrix is uploaded once as its own table and joined in
+    # Redshift, so rows only carry their ids and target_name
+    data = compact_send_lists(data.dropna(axis=1, how='all'),
+                              test_matrix.target_name)
+    if identity_cache is not None:
+        data = identity_cache.attach_user_ids(data)
+        data['user_id'] = data.user_id.astype('Int64')
 
     logging.info("Dataframe created from {n_files} files " \
-                 "with {n_records} records in {n_cols} columns".format(
-                 n_files = len(targets_by_file.keys()),
+                 "with {n_records} records in {n_cols} columns " \
+                 "using {n_mb:.1f} MB".format(
+                 n_files = len(targets_by_file),
                  n_records = data.shape[0],
-                 n_cols = data.shape[1]))
+                 n_cols = data.shape[1],
+                 n_mb = data.memory_usage(deep = True).sum() / 2**20))
     return data
 
-def process_single_file(path, target):
-    id_cols = ['user_id', 'internal_user_id', 'prospect_id',
-               'email', 'email_address']
+
+def compact_send_lists(data, target_names):
+    # a list may carry both user_id and internal_user_id
+    if 'internal_user_id' in data.columns:
+        user_ids = data.pop('internal_user_id')
+        data['user_id'] = (data.user_id.fillna(user_ids)
+                           if 'user_id' in data.columns else user_ids)
+    if 'email_address' in data.columns:
+        emails = data.pop('email_address')
+        data['email'] = (data.email.fillna(emails)
+                         if 'email' in data.columns else emails)
+
+    for col in ['user_id', 'prospect_id']:
+        if col in data.columns:
+            ids = pd.to_numeric(data[col], errors='coerce')
+            # ids that are not numbers cannot be matched to users and are
+            # dropped, so they are reported rather than nulled silently
+            invalid = data[col][ids.isnull() & data[col].notnull()]
+            if len(invalid):
+                logging.warning('{:,} {} values are not numeric and were '
+                    'set to null, e.g. {}'.format(len(invalid), col,
+                    ', '.join(map(repr, invalid.unique()[:5]))))
+            data[col] = ids.astype('Int64')
+    for col in ['email', 'external_id']:
+        if col in data.columns:
+            data[col] = data[col].astype(STRING_DTYPE)
+    data['target_name'] = pd.Categorical(data.target_name,
+        categories = pd.unique(target_names.dropna().astype(str)))
+    return data.reset_index(drop = True)
+
+
+def parse_send_lists(targets_by_file, cache = None, max_workers = 4,
+                     failed = None):
+    # CSV reads are mostly I/O and share a thread pool, Excel parsing is
+    # CPU-bound pure Python and gets worker processes; frames are yielded
+    # in file order regardless of which finishes first
+    failed = [] if failed is None else failed
+    cached = {path: cache.load(path) if cache is not None else None
+              for path in targets_by_file}
+    n_excel = sum(1 for path, data in cached.items()
+                  if data is None and not path.endswith('csv'))
+    # worker processes are only started for uncached Excel files, and are
+    # spawned rather than forked since campaigns run on threads of their own
+    with ThreadPoolExecutor(max_workers = max_workers) as threads, \
+         (ProcessPoolExecutor(max_workers = min(max_workers, n_excel),
+              mp_context = multiprocessing.get_context('spawn'))
+          if n_excel else nullcontext()) as processes:
+        pending = []
+        for path, target in targets_by_file.items():
+            data = cached.pop(path)
+            if data is not None:
+                logging.info('{} loaded from cache'.format(path))
+                pending.append((path, target, data))
+            else:
+                encoding = (cache.encoding(path) if cache is not None
+                            else None)
+                # threads run in a copy of the campaign's context so their
+                # records reach its logs; Excel parsing does not log, and
+                # its errors are logged here when the result is read
+                if path.endswith('csv'):
+                    result = threads.submit(contextvars.copy_context().run,
+                                            read_id_columns, path, encoding)
+                else:
+                    result = processes.submit(read_id_columns, path,
+                                              encoding)
+                pending.append((path, target, result))
+
+        for path, target, result in pending:
+            if isinstance(result, pd.DataFrame):
+                data = result
+            else:
+                try:
+                    data, encoding = result.result()
+                except Exception:
+                    logging.exception('{} could not be processed'
+                                      .format(path))
+                    failed.append(path)
+                    continue
+                if cache is not None:
+                    cache.store(path, data, encoding = encoding)
+                logging.info('{} successfully processed{}'.format(path,
+                    ' as {}'.format(encoding) if encoding else ''))
+
+            data['target_name'] = target
+            yield data
+
+
+def read_id_columns(path, encoding = None):
+    id_cols = SEND_LIST_ID_COLUMNS
 
     if path.endswith('csv'):
+        encoding = encoding or detect_encoding(path)
         try:
-            data = pd.read_csv(path, header=0,
+            data = pd.read_csv(path, header=0, encoding=encoding,
                 usecols=lambda x: x.lower().replace(' ', '_') in id_cols)
         except UnicodeDecodeError:
-            data = pd.read_csv(path, header=0,
-                usecols=lambda x: x.lower().replace(' ', '_') in id_cols,
-                encoding='iso-8859-1')
+            # only reached when bytes past the sampled prefix are not
+            # valid in the detected encoding
+            logging.warning('{} is not valid {}, reading as iso-8859-1'
+                            .format(path, encoding))
+            encoding = 'iso-8859-1'
+            data = pd.read_csv(path, header=0, encoding=encoding,
+                usecols=lambda x: x.lower().replace(' ', '_') in id_cols)
     else:
-        data = pd.read_excel(path).drop()
+        data = pd.read_excel(path)
         keep_cols = [col for col in data.columns
-            if col.lower().replace(' ', '_') in id_cols]
+            if str(col).lower().replace(' ', '_') in id_cols]
         data = data[keep_cols]
 
     data.columns = [col.lower().replace(' ', '_')
         for col in data.columns]
-    data['target_name'] = target
-    logging.info('{} successfully processed'.format(path))
-    return data
+    return data, encoding
+
+
+def stream_send_lists(campaign_dir, test_matrix, bucket, s3dir, info,
+                      n_parts = 1, chunksize = 500000,
+                      partition_mb = 64, work_dir = None,
+                      identity_cache = None, targets_by_file = None,
+                      upload = True, cache = None):
+    # out-of-core alternative to process_send_lists: files are read in
+    # chunks and hash-partitioned on local disk by target_name and id,
+    # then each partition is deduplicated and streamed to S3 as part of
+    # one of n_parts staged files, so memory is bounded by partition size
+    if targets_by_file is None:
+        targets_by_file, _, _ = index_send_lists(campaign_dir,
+                                                 test_matrix.target_name)
+    source_bytes = sum(os.path.getsize(f) for f in targets_by_file)
+    n_partitions = max(n_parts, -(-source_bytes // (partition_mb * 2**20)))
+    raw_cols = SEND_LIST_ID_COLUMNS + ['target_name']
+
+    with TemporaryDirectory(dir = work_dir) as tmp_dir:
+        partition_paths = [str(Path(tmp_dir, 'partition_{:05d}.csv'.format(i)))
+                           for i in range(n_partitions)]
+        non_null_cols, n_records, failed = set(), 0, []
+
+        def partition_file(path, target, file_paths, encoding):
+            file_cols, file_records = set(), 0
+            for chunk in read_id_chunks(path, chunksize, encoding = encoding):
+                chunk = (chunk.assign(target_name = target)
+                              .reindex(columns = raw_cols))
+                file_cols.update(chunk.columns[chunk.notnull().any()])
+                file_records += len(chunk)
+
+                first_id = chunk[SEND_LIST_ID_COLUMNS].bfill(axis=1).iloc[:, 0]
+                partition = pd.util.hash_pandas_object(pd.DataFrame(
+                    {'target_name': chunk.target_name,
+                     'id': first_id.astype(str)}),
+                    index = False) % n_partitions
+                for i, part in chunk.groupby(partition.values):
+                    part.to_csv(file_paths[i], mode = 'a',
+                                header = False, index = False)
+            return file_cols, file_records
+
+        def discard(file_paths):
+            [os.remove(file_path) for file_path in file_paths
+                if os.path.exists(file_path)]
+
+        for path, target in targets_by_file.items():
+            # a file is partitioned on its own and only merged into the
+            # campaign partitions once all of it has been read
+            file_paths = [partition + '.file' for partition in partition_paths]
+            encoding = None
+            if path.endswith('csv'):
+                encoding = ((cache.encoding(path) if cache is not None
+                             else None) or detect_encoding(path))
+            try:
+                try:
+                    file_cols, file_records = partition_file(path, target,
+                        file_paths, encoding)
+                except UnicodeDecodeError:
+                    # as in read_id_columns, bytes past the sampled prefix
+                    # are not valid in the detected encoding; the chunks
+                    # already partitioned are dropped and the file reread
+                    logging.warning('{} is not valid {}, reading as '
+                                    'iso-8859-1'.format(path, encoding))
+                    discard(file_paths)
+                    file_cols, file_records = partition_file(path, target,
+                        file_paths, 'iso-8859-1')
+            except Exception:
+                logging.exception('{} could not be processed'.format(path))
+                failed.append(path)
+                discard(file_paths)
+                continue
+
+            for file_path, partition_path in zip(file_paths, partition_paths):
+                if os.path.exists(file_path):
+                    with open(file_path, 'rb') as src, \
+                         open(partition_path, 'ab') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(file_path)
+            non_null_cols.update(file_cols)
+            n_records += file_records
+            logging.info('{} successfully partitioned'.format(path))
+
+        # as with process_send_lists, nothing is staged unless every file
+        # was read
+        if failed:
+            raise ValueError('{} of {} send lists could not be processed: {}'
+                .format(len(failed), len(targets_by_file), ', '.join(failed)))
+
+        keep_cols = [col for col in raw_cols if col in non_null_cols]
+        stats = {'n_unique': 0, 'user_ids_missing': False, 'schema': None}
+
+        def deduplicated_partitions(part_number):
+            for path in partition_paths[part_number::n_parts]:
+                if not os.path.exists(path):
+                    continue
+                data = (pd.read_csv(path, header = None, names = raw_cols,
+                                    dtype = str)[keep_cols]
+                          .drop_duplicates())
+                data = compact_send_lists(data, test_matrix.target_name)
+                if identity_cache is not None:
+                    data = identity_cache.attach_user_ids(data)
+                    data['user_id'] = data.user_id.astype('Int64')
+                stats['n_unique'] += len(data)
+                stats['user_ids_missing'] |= ('user_id' not in data.columns
+                    or bool(data.user_id.isnull().any()))
+                stats['schema'] = data.iloc[:0]
+                yield data
+
+        # parts are written one after another so only a single partition
+        # is held in memory at a time
+        s3_writer = S3ReadWrite(bucket=bucket, folder=s3dir)
+        csv_path = info.campaign_name.strip()
+        csv_name = info.campaign_short_name.strip().lower()
+        part_dir = '{}/{}/{}'.format(s3dir, csv_path, csv_name)
+        entries, fullpath = [], None
+        if upload:
+            s3_writer.delete_prefix_from_S3('{}/part_'.format(part_dir))
+        for i in range(n_parts):
+            key = '{}/part_{:04d}.csv.gz'.format(part_dir, i)
+            if not upload:
+                # a dry run reads every partition for the schema only
+                for _ in deduplicated_partitions(i):
+                    pass
+                continue
+            entries.append((key, s3_writer.stream_csv_to_S3(
+                key, deduplicated_partitions(i))))
+        if upload:
+            fullpath = s3_writer.put_manifest_to_S3(
+                '{}.manifest'.format(part_dir), entries)
+
+    if stats['schema'] is None:
+        raise ValueError('No send list records found in {}'.format(
+            campaign_dir))
+    logging.info("Streamed {n_files} files with {n_records} records " \
+                 "({n_unique} after removing duplicates) in {n_cols} " \
+                 "columns {destination}".format(
+                 n_files = len(targets_by_file),
+                 n_records = n_records,
+                 n_unique = stats['n_unique'],
+                 n_cols = len(stats['schema'].columns),
+                 destination = 'to {} parts listed in {}'.format(
+                     n_parts, fullpath) if upload else 'without uploading'))
+    return fullpath, stats['schema'], stats['user_ids_missing']
+
+
+def read_id_chunks(path, chunksize, encoding = None):
+    id_cols = SEND_LIST_ID_COLUMNS
+    if path.endswith('csv'):
+        chunks = pd.read_csv(path, header=0, dtype=str,
+            encoding=encoding or detect_encoding(path), chunksize=chunksize,
+            usecols=lambda x: x.lower().replace(' ', '_') in id_cols)
+    else:
+        # Excel workbooks cannot be read incrementally
+        data, _ = read_id_columns(path)
+        chunks = (data.iloc[i:i + chunksize]
+                  for i in range(0, len(data), chunksize))
+
+    for chunk in chunks:
+        chunk.columns = [col.lower().replace(' ', '_')
+            for col in chunk.columns]
+        yield id_strings(chunk)
+
+
+def id_strings(chunk):
+    # ids are hashed and deduplicated as text, so the 123.0 Excel reads
+    # for a numeric id has to match the '123' of a CSV
+    return chunk.apply(lambda values:
+                       normalize_ids(values).where(values.notnull()))
+
+
+def count_slices(engine):
+    with engine.begin() as connection:
+        return connection.execute('SELECT COUNT(*) FROM stv_slices').scalar()
 
 
-def upload_to_s3(data, bucket, s3dir, info):
+def upload_to_s3(data, bucket, s3dir, info, n_parts = 1, file_format = 'csv',
+                 csv_name = None):
+    # stage the data as n_parts objects plus a COPY manifest listing them,
+    # so each Redshift slice can load a part in parallel
     s3_writer = S3ReadWrite(bucket=bucket, folder=s3dir)
     logging.info('S3ReadWrite created in {}'.format(str(s3_writer)))
     csv_path = info.campaign_name.strip()
-    csv_name = info.campaign_short_name.strip().lower()
-    s3_writer.put_dataframe_to_S3(csv_path=csv_path,
-                                  csv_name=csv_name, dataframe=data)
-    fullpath = str(Path(s3dir, csv_path, '{}.csv'.format(csv_name)))
-    logging.info('data saved in S3 bucket at {}'.format(fullpath))
+    csv_name = csv_name or info.campaign_short_name.strip().lower()
+    part_dir = '{}/{}/{}'.format(s3dir, csv_path, csv_name)
+
+    n_parts = max(1, min(n_parts, len(data)))
+    bounds = [len(data) * i // n_parts for i in range(n_parts + 1)]
+    parts = [data.iloc[start:end] for start, end in zip(bounds, bounds[1:])]
+    # parts left by an earlier load with more parts are never listed in the
+    # manifest, but are removed so the directory only holds this load
+    s3_writer.delete_prefix_from_S3('{}/part_'.format(part_dir))
+
+    def stage_part(i, part, chunksize = 100000):
+        if file_format == 'parquet':
+            key = '{}/part_{:04d}.parquet'.format(part_dir, i)
+            return key, s3_writer.put_dataframe_to_S3_parquet(key, part)
+        else:
+            # each part is encoded a slice at a time, so the staging
+            # threads never hold a whole part as CSV text
+            key = '{}/part_{:04d}.csv.gz'.format(part_dir, i)
+            return key, s3_writer.stream_csv_to_S3(key,
+                (part.iloc[j:j + chunksize]
+                 for j in range(0, max(len(part), 1), chunksize)))
+
+    with ThreadPoolExecutor(max_workers = min(n_parts, 4)) as executor:
+        entries = [future.result() for future in [
+            executor.submit(contextvars.copy_context().run, stage_part,
+                            i, part) for i, part in enumerate(parts)]]
+
+    fullpath = s3_writer.put_manifest_to_S3(
+        '{}.manifest'.format(part_dir), entries)
+    logging.info('data saved in S3 bucket as {} {} parts listed in {}'
+                 .format(n_parts, file_format, fullpath))
     return fullpath, csv_name
 
 
+def redshift_column_type(series):
+    # column type and compression encoding for a normalized column; columns
+    # read as all-null floats fall through to text, which accepts whatever
+    # a later load puts in them
+    if pd.api.types.is_bool_dtype(series):
+        return 'BOOLEAN', 'ZSTD'
+    elif pd.api.types.is_integer_dtype(series):
+        return 'BIGINT', 'AZ64'
+    elif pd.api.types.is_float_dtype(series) and series.notnull().any():
+        return 'DOUBLE PRECISION', 'ZSTD'
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        return 'TIMESTAMP', 'AZ64'
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        values, encoding = pd.Series(series.cat.categories), 'BYTEDICT'
+    else:
+        values, encoding = series.dropna(), 'ZSTD'
+    # known text columns keep a fixed width so that an incremental load of
+    # a longer value still fits
+    width = VARCHAR_WIDTHS.get(series.name)
+    if len(values):
+        n_bytes = values.astype(str).str.encode('utf-8').str.len().max()
+        width = min(max(width or 16, 2 ** int(n_bytes - 1).bit_length()),
+                    65535)
+    return 'VARCHAR({})'.format(width or 256), encoding
+
+
+def build_table_ddl(data, tbl, distkey = None, sortkey = (),
+                    diststyle = None):
+    columns = []
+    for col in data.columns:
+        col_type, encoding = redshift_column_type(data[col])
+        # zone maps on the leading sort key column work best uncompressed
+        if sortkey and col == sortkey[0]:
+            encoding = 'RAW'
+        columns.append('{} {} ENCODE {}'.format(col, col_type, encoding))
+
+    return """CREATE TABLE {tbl} (
+    {columns}
+){diststyle}{distkey}{sortkey}""".format(
+        tbl = tbl,
+        columns = ',\n    '.join(columns),
+        diststyle = '\nDISTSTYLE {}'.format(diststyle) if diststyle else '',
+        distkey = '\nDISTKEY({})'.format(distkey) if distkey else '',
+        sortkey = '\nSORTKEY({})'.format(', '.join(sortkey))
+                  if sortkey else '')
+
+
+def campaign_table_keys(columns):
+    # campaign tables are joined to dw tables on user_id, and every query
+    # filters or groups them by target_name
+    distkey = 'user_id' if 'user_id' in columns else None
+    sortkey = tuple(col for col in ('target_name', 'user_id')
+                    if col in columns)
+    return distkey, sortkey
+
+
 def upload_to_redshift(bucket, filename, tbl_name, engine, data, usernames,
-                       iam = 308127741254, role = 'RedshiftCopy'):
+                       iam = 308127741254, role = 'RedshiftCopy',
+                       compression = None, manifest = False,
+                       file_format = 'csv', diststyle = None):
     iam_role = 'arn:aws:iam::{iam}:role/{role}'.format(iam=iam , role=role)
 
     tbl = tbl_name if tbl_name.startswith('analytics.') \
                    else 'analytics.{}'.format(tbl_name)
-    create_table_query = (get_schema(data, tbl, con=engine)
-                          .replace('"{}"'.format(tbl), tbl))
+    distkey, sortkey = (campaign_table_keys(data.columns)
+                        if diststyle is None else (None, ()))
+    create_table_query = build_table_ddl(data, tbl, distkey = distkey,
+        sortkey = sortkey, diststyle = diststyle)
+
+    # encodings come from the DDL, so COPY must not re-derive them
+    if file_format == 'parquet':
+        format_options = 'FORMAT AS PARQUET'
+    else:
+        format_options = """CSV BLANKSASNULL IGNOREHEADER AS 1 COMPUPDATE OFF TIMEFORMAT 'auto'
+         FILLRECORD STATUPDATE ON {}""".format(compression or '')
 
     copy_data_query = """ COPY {table_name}
     FROM 's3://{bucket}/{filename}'
          iam_role '{iam_role}'
-         CSV BLANKSASNULL IGNOREHEADER AS 1 COMPUPDATE ON TIMEFORMAT 'auto'
-         FILLRECORD STATUPDATE ON""".format(
+         {format_options} {manifest}""".format(
          table_name = tbl,
          bucket = bucket,
          filename = filename,
-         iam_role = iam_role)
-
-    grant_privilege_queries = ["GRANT SELECT ON TABLE {table} to {user}"
-                               .format(table=tbl, user=username )
-                               for username in usernames]
+         iam_role = iam_role,
+         format_options = format_options,
+         manifest = 'MANIFEST' if manifest else '')
 
     with engine.begin() as connection:
         connection.execute(create_table_query)
@@ -102,10 +488,16 @@ def upload_to_redshift(bucket, filename, tbl_name, engine, data, usernames,
         connection.execute(copy_data_query)
         logging.info("Data copied from s3://{bucket}/{filename} to {table}".format(
             bucket = bucket, filename = filename, table = tbl))
-        [connection.execute(grant_select)
-            for grant_select in grant_privilege_queries]
-        logging.info('SELECT privileges granted to {}'.format(
-            " ,".join(usernames)))
+        connection.execute('ANALYZE {}'.format(tbl))
+        grant_select(connection, tbl, usernames)
+
+
+def grant_select(connection, tbl, usernames):
+    [connection.execute("GRANT SELECT ON TABLE {table} to {user}"
+                        .format(table=tbl, user=username))
+        for username in usernames]
+    logging.info('SELECT privileges granted to {}'.format(
+        " ,".join(usernames)))
 
 
 def extract_campaign_info(args):
@@ -130,65 +522,253 @@ def extract_campaign_info(args):
     return campaign_dir, template[test_matrix_cols], campaign_info
 
 
-def replace_table(data, engine, args, usernames, campaign_info):
-    tbl_name = campaign_info.campaign_short_name
-    drop_table = "DROP TABLE IF EXISTS analytics.{}".format(tbl_name)
-
+def load_staging_table(data, engine, args, usernames, campaign_info,
+                       staging, s3_path = None, user_ids_missing = None):
+    # s3_path is given when the data was already staged, in which case
+    # data only needs to describe the table's columns
     with engine.begin() as connection:
-        connection.execute(drop_table)
-    logging.info('Table analytics.{} dropped'.format(tbl_name))
-
-    s3_path, tbl_name = upload_to_s3(data, args.bucket, args.s3dir,
-                                     info = campaign_info)
+        connection.execute('DROP TABLE IF EXISTS analytics.{}'.format(
+            staging))
+
+    file_format = args.staging_format if s3_path is None else 'csv'
+    if s3_path is None:
+        n_parts = args.n_parts or count_slices(engine)
+        s3_path, _ = upload_to_s3(data, args.bucket, args.s3dir,
+                                  info = campaign_info, n_parts = n_parts,
+                                  file_format = file_format)
     upload_to_redshift(args.bucket, s3_path,
-        tbl_name = tbl_name, engine = engine,
-        data = data, usernames = usernames)
+        tbl_name = staging, engine = engine,
+        data = data, usernames = usernames, compression = 'GZIP',
+        manifest = True, file_format = file_format)
+    update_campaign_table(data, engine, args, usernames, campaign_info,
+                          user_ids_missing = user_ids_missing,
+                          tbl_name = staging)
+
+
+def replace_table(data, engine, args, usernames, campaign_info,
+                  s3_path = None, user_ids_missing = None,
+                  fingerprints = None):
+    # the new table is loaded and resolved under a staging name and then
+    # swapped in, so the campaign table is never missing for readers
+    tbl_name = campaign_info.campaign_short_name.strip().lower()
+    staging = '{}_staging'.format(tbl_name)
+    load_staging_table(data, engine, args, usernames, campaign_info,
+                       staging, s3_path = s3_path,
+                       user_ids_missing = user_ids_missing)
+
+    with engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS analytics.{}'.format(
+            tbl_name))
+        connection.execute('ALTER TABLE analytics.{} RENAME TO {}'.format(
+            staging, tbl_name))
+        if fingerprints is not None:
+            write_load_ledger(connection, tbl_name, fingerprints)
     logging.info('Table analytics.{} replaced'.format(tbl_name))
 
 
-def update_campaign_table(data, engine, args, usernames, campaign_info):
-    tbl_name = campaign_info.campaign_short_name
+def apply_table_delta(data, engine, args, usernames, campaign_info, targets,
+                      fingerprints, s3_path = None, user_ids_missing = None):
+    # replace the rows of changed targets in place with delete + insert in
+    # one transaction; returns False if the delta does not fit the table
+    tbl_name = campaign_info.campaign_short_name.strip().lower()
+    staging = '{}_delta'.format(tbl_name)
+    targets_q = ', '.join(quote_literal(target) for target in targets)
+
+    try:
+        if data is not None:
+            load_staging_table(data, engine, args, usernames, campaign_info,
+                               staging, s3_path = s3_path,
+                               user_ids_missing = user_ids_missing)
+            staging_cols = table_columns(engine, staging)
+            new_cols = set(staging_cols) - set(table_columns(engine, tbl_name))
+            if new_cols:
+                logging.warning('Delta adds columns {} to analytics.{}'.format(
+                    ', '.join(sorted(new_cols)), tbl_name))
+                return False
+
+        with engine.begin() as connection:
+            deleted = connection.execute(
+                'DELETE FROM analytics.{} WHERE target_name IN ({})'.format(
+                    tbl_name, targets_q)).rowcount
+            inserted = 0
+            if data is not None:
+                inserted = connection.execute(
+                    """INSERT INTO analytics.{tbl} ({cols})
+                    SELECT {cols} FROM analytics.{staging}""".format(
+                    tbl = tbl_name, staging = staging,
+                    cols = ', '.join(staging_cols))).rowcount
+            connection.execute('ANALYZE analytics.{}'.format(tbl_name))
+            write_load_ledger(connection, tbl_name,
+                fingerprints[fingerprints.target_name.isin(targets)],
+                targets = targets)
+    finally:
+        # the delta table is dropped whether or not it was applied
+        if data is not None:
+            with engine.begin() as connection:
+                connection.execute('DROP TABLE IF EXISTS analytics.{}'
+                                   .format(staging))
+
+    logging.info('Table analytics.{} updated for {} targets: {} rows '
+                 'deleted and {} rows inserted'.format(
+                 tbl_name, len(targets), deleted, inserted))
+    return True
+
+
+def quote_literal(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def table_columns(engine, tbl_name):
+    with engine.begin() as connection:
+        return [row[0] for row in connection.execute(
+            """SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'analytics' AND table_name = {}
+            ORDER BY ordinal_position""".format(quote_literal(tbl_name)))]
+
+
+def fingerprint_send_lists(targets_by_file, campaign_dir, cache = None):
+    return pd.DataFrame([{'target_name': target,
+        'file_path': os.path.relpath(path, str(campaign_dir)),
+        'content_hash': (cache.digest(path) if cache is not None
+                         else file_digest(path))}
+        for path, target in targets_by_file.items()],
+        columns = ['target_name', 'file_path', 'content_hash'])
+
+
+def read_load_ledger(engine, tbl_name):
+    # files (and their content hashes) the campaign table was loaded from
+    if not (engine.has_table(tbl_name, schema = 'analytics') and
+            engine.has_table('{}_loaded_files'.format(tbl_name),
+                             schema = 'analytics')):
+        return None
+    return pd.read_sql_query("""SELECT target_name, file_path, content_hash
+        FROM analytics.{}_loaded_files""".format(tbl_name), engine)
+
+
+def write_load_ledger(connection, tbl_name, fingerprints, targets = None):
+    ledger = 'analytics.{}_loaded_files'.format(tbl_name)
+    connection.execute("""CREATE TABLE IF NOT EXISTS {} (
+        target_name VARCHAR(256),
+        file_path VARCHAR(1024),
+        content_hash VARCHAR(40),
+        loaded_at TIMESTAMP)""".format(ledger))
+    connection.execute('DELETE FROM {} {}'.format(ledger,
+        '' if targets is None else 'WHERE target_name IN ({})'.format(
+            ', '.join(quote_literal(target) for target in targets))))
+    if len(fingerprints):
+        connection.execute(text("""INSERT INTO {} VALUES
+            (:target_name, :file_path, :content_hash, getdate())"""
+            .format(ledger)), fingerprints.to_dict('records'))
+
+
+def changed_targets(fingerprints, ledger):
+    # targets with any new, changed or removed file since the last load
+    current = set(fingerprints.itertuples(index = False, name = None))
+    loaded = set(ledger.itertuples(index = False, name = None))
+    return sorted({target for target, _, _ in current ^ loaded})
+
+
+def upload_test_matrix(test_matrix, engine, args, usernames, campaign_info):
+    tbl_name = '{}_test_matrix'.format(
+        campaign_info.campaign_short_name.strip().lower())
+
+    staging = '{}_staging'.format(tbl_name)
+
+    with engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS analytics.{}'.format(
+            staging))
+
+    s3_path, _ = upload_to_s3(test_matrix, args.bucket, args.s3dir,
+                              info = campaign_info, csv_name = tbl_name)
+    upload_to_redshift(args.bucket, s3_path,
+        tbl_name = staging, engine = engine,
+        data = test_matrix, usernames = usernames, compression = 'GZIP',
+        manifest = True, diststyle = 'ALL')
+
+    with engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS analytics.{}'.format(
+            tbl_name))
+        connection.execute('ALTER TABLE analytics.{} RENAME TO {}'.format(
+            staging, tbl_name))
+    logging.info('Test matrix uploaded to analytics.{}'.format(tbl_name))
+
+
+def resolve_user_ids(engine, tbl_name, id_col, users_col, usernames,
+                     columns = None):
+    # add user_id by joining to dw.users inside Redshift: build the
+    # resolved table with CTAS, then swap it in under the original name;
+    # if columns already include user_id only its missing values are joined
+    tbl = 'analytics.{}'.format(tbl_name)
+    staging = 'analytics.{}_resolved'.format(tbl_name)
+
+    if columns is not None and 'user_id' in columns:
+        select_cols = ''.join('a.{}, '.format(col)
+                              for col in columns if col != 'user_id')
+        user_id = 'COALESCE(a.user_id, u.internal_user_id)'
+        missing_only = 'AND a.user_id IS NULL'
+    else:
+        select_cols, user_id, missing_only = 'a.*, ', 'u.internal_user_id', ''
+
+    resolve_query = """CREATE TABLE {staging}
+    DISTKEY(user_id) SORTKEY(target_name, user_id) AS
+    SELECT {select_cols}
+        {user_id} AS user_id
+    FROM {tbl} a
+    LEFT JOIN dw.users u
+    ON u.{users_col} = a.{id_col}
+    AND u.internal_user_id is not null
+    {missing_only}
+    """.format(staging = staging, tbl = tbl, select_cols = select_cols,
+               user_id = user_id, users_col = users_col, id_col = id_col,
+               missing_only = missing_only)
+
+    count_query = """SELECT COUNT(user_id) AS resolved,
+        COUNT(*) - COUNT(user_id) AS unresolved
+    FROM {}""".format(staging)
 
-    if 'user_id' in data.columns:
+    with engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(staging))
+        connection.execute(resolve_query)
+        resolved, unresolved = connection.execute(count_query).fetchone()
+        connection.execute('ANALYZE {}'.format(staging))
+        connection.execute('DROP TABLE {}'.format(tbl))
+        connection.execute('ALTER TABLE {} RENAME TO {}'.format(
+            staging, tbl_name))
+        grant_select(connection, tbl, usernames)
+
+    logging.info('{resolved} rows resolved to a user_id and {unresolved} '
+                 'unresolved in {tbl}'.format(resolved = resolved,
+                 unresolved = unresolved, tbl = tbl))
+
+
+def update_campaign_table(data, engine, args, usernames, campaign_info,
+                          user_ids_missing = None, tbl_name = None):
+    tbl_name = tbl_name or campaign_info.campaign_short_name
+    # user ids attached from the identity cache may still have gaps
+    # that the warehouse can fill from another id column
+    if user_ids_missing is None:
+        user_ids_missing = ('user_id' in data.columns
+                            and data.user_id.isnull().any())
+    fill_missing = ('user_id' in data.columns and user_ids_missing
+        and any(col in data.columns for col, _ in ID_COLUMNS))
+
+    if 'user_id' in data.columns and not fill_missing:
         logging.info('User_id column found as primary identifier')
 
     elif 'prospect_id' in data.columns:
-        join_query = """SELECT a.*,
-            u.internal_user_id AS user_id
-        FROM analytics.{} a
-        LEFT JOIN dw.users u
-        ON u.internal_marketing_prospect_id = a.prospect_id
-        AND u.internal_user_id is not null
-        """.format(tbl_name)
-
-        data = pd.read_sql_query(text(join_query), engine)
-        replace_table(data, engine, args, usernames, campaign_info)
+        resolve_user_ids(engine, tbl_name, 'prospect_id',
+                         'internal_marketing_prospect_id', usernames,
+                         columns = data.columns)
         logging.info('Joined on marketing_prospect_id and added user_id')
 
     elif 'external_id' in data.columns:
-        join_query = """SELECT a.*,
-            u.internal_user_id AS user_id
-        FROM analytics.{} a
-        LEFT JOIN dw.users u
-        ON u.external_id = a.external_id
-        AND u.internal_user_id is not null
-        """.format(tbl_name)
-
-        data = pd.read_sql_query(text(join_query), engine)
-        replace_table(data, engine, args, usernames, campaign_info)
+        resolve_user_ids(engine, tbl_name, 'external_id',
+                         'external_id', usernames, columns = data.columns)
         logging.info('Joined on external_id and added user_id')
 
     elif 'email' in data.columns:
-        join_query = """SELECT a.*,
-            u.internal_user_id AS user_id
-        FROM analytics.{} a
-        LEFT JOIN dw.users u
-        ON u.email = a.email
-        AND u.internal_user_id is not null
-        """.format(tbl_name)
-
-        data = pd.read_sql_query(text(join_query), engine)
-        replace_table(data, engine, args, usernames, campaign_info)
+        resolve_user_ids(engine, tbl_name, 'email', 'email', usernames,
+                         columns = data.columns)
         logging.info('Joined on user email address and added user_id')
 
     else:
@@ -215,28 +795,167 @@ def main(args):
     [logging.info('Input argument {} set to {}'.format(k, v))
         for k,v in vars(args).items()]
 
-    # extract information from campaign template file
-    campaign_dir, test_matrix, campaign_info = extract_campaign_info(args)
-    # concatenate all send lists into DataFrame
-    data = process_send_lists(campaign_dir, test_matrix)
+    engine = create_redshift_engine()
+    refresh_identity_cache(args, engine)
+    upload_campaign(args, engine)
 
-    usernames = ['production_read_only', 'analytics_team', 'prod_application']
+
+def create_redshift_engine(pool_size = 5):
     # connect to database via Strong DM
-    engine = create_engine('{driver}://{host}:{port}/{dbname}'.format(
+    return create_engine('{driver}://{host}:{port}/{dbname}'.format(
           driver = 'postgresql+psycopg2',
           host = 'localhost',
           port = 5439,
-          dbname = 'production'))
+          dbname = 'production'),
+        pool_size = pool_size)
+
+
+def upload_campaign(args, engine):
+    # extract information from campaign template file
+    campaign_dir, test_matrix, campaign_info = extract_campaign_info(args)
+    cache = None if args.no_cache else SendListCache(
+        Path(args.cache_dir, 'send_lists', campaign_dir.name),
+        max_bytes = args.cache_max_mb * 2**20,
+        max_age_days = args.cache_max_age_days)
+    # the identity cache is refreshed once per run by refresh_identity_cache,
+    # uploads only read it
+    identity_cache = None
+    if args.identity_cache:
+        identity_cache = IdentityCache(args.identity_cache,
+                                       ttl_days = args.identity_cache_ttl_days)
+    usernames = ['production_read_only', 'analytics_team', 'prod_application']
+    tbl_name = campaign_info.campaign_short_name.strip().lower()
+
+    targets_by_file, _, _ = index_send_lists(campaign_dir,
+                                             test_matrix.target_name)
+    ledger = read_load_ledger(engine, tbl_name) if args.incremental else None
+    fingerprints = None
+    if ledger is not None:
+        # only targets whose files changed since the last load are reloaded
+        fingerprints = fingerprint_send_lists(targets_by_file, campaign_dir,
+                                              cache = cache)
+        targets = changed_targets(fingerprints, ledger)
+        targets_by_file = {path: target
+            for path, target in targets_by_file.items() if target in targets}
+        logging.info('{} of {} targets changed since the last load'.format(
+            len(targets), test_matrix.target_name.nunique()))
+    elif args.incremental:
+        logging.info('No previous load of analytics.{} found, loading all '
+                     'send lists'.format(tbl_name))
+
+    data = s3_path = user_ids_missing = None
+    if args.streaming and targets_by_file:
+        # stage send lists chunk by chunk without building one DataFrame
+        s3_path, data, user_ids_missing = stream_send_lists(
+            campaign_dir, test_matrix, args.bucket, args.s3dir,
+            info = campaign_info,
+            n_parts = args.n_parts or count_slices(engine),
+            chunksize = args.chunksize, work_dir = args.work_dir,
+            identity_cache = identity_cache,
+            targets_by_file = targets_by_file,
+            upload = not args.dry_run, cache = cache)
+    elif targets_by_file:
+        # concatenate all send lists into DataFrame
+        data = process_send_lists(campaign_dir, test_matrix, cache = cache,
+                                  max_workers = args.parse_workers,
+                                  identity_cache = identity_cache,
+                                  targets_by_file = targets_by_file)
+    # only files that were read into the table are recorded as loaded, and
+    # they are only hashed for the load ledger a dry run does not write;
+    # the send list cache already knows the digests of the files it parsed
+    if fingerprints is not None:
+        loaded_files = [os.path.relpath(path, str(campaign_dir))
+                        for path in targets_by_file]
+        fingerprints = fingerprints[fingerprints.file_path.isin(loaded_files)]
+    elif not args.dry_run:
+        fingerprints = fingerprint_send_lists(targets_by_file, campaign_dir,
+                                              cache = cache)
+    if cache is not None:
+        cache.evict()
+        cache.save()
+
+    if args.dry_run and data is not None:
+        distkey, sortkey = campaign_table_keys(data.columns)
+        logging.info('DDL for analytics.{}:\n{}'.format(tbl_name,
+            build_table_ddl(data, 'analytics.{}'.format(tbl_name),
+                            distkey = distkey, sortkey = sortkey)))
+        logging.info('DDL for analytics.{}_test_matrix:\n{}'.format(tbl_name,
+            build_table_ddl(test_matrix, 'analytics.{}_test_matrix'.format(
+                tbl_name), diststyle = 'ALL')))
+    if args.dry_run:
+        return
 
     # upload csv of concatenated send lists to S3
     # copy data from S3 to new table in Redshift
-    replace_table(data, engine, args, usernames, campaign_info)
-
-    update_campaign_table(data, engine, args, usernames, campaign_info)
+    if ledger is not None and not targets:
+        logging.info('Table analytics.{} is up to date'.format(tbl_name))
+    elif ledger is None or not apply_table_delta(data, engine, args,
+            usernames, campaign_info, targets, fingerprints,
+            s3_path = s3_path, user_ids_missing = user_ids_missing):
+        if ledger is not None:
+            # the delta could not be applied in place, reload everything
+            return upload_campaign(Namespace(**dict(vars(args),
+                                                    incremental = False)),
+                                   engine)
+        replace_table(data, engine, args, usernames, campaign_info,
+                      s3_path = s3_path, user_ids_missing = user_ids_missing,
+                      fingerprints = fingerprints)
+    upload_test_matrix(test_matrix, engine, args, usernames, campaign_info)
 
     logging.info('Database upload completed successfully for {}'
                  .format(args.campaign_dir))
 
+def refresh_identity_cache(args, engine):
+    # called before any upload starts, since concurrent uploads sharing the
+    # sqlite file would each wait on and repeat the same reload; a dry run
+    # resolves ids against the cache as it is
+    if args.identity_cache and not args.dry_run:
+        IdentityCache(args.identity_cache,
+            ttl_days = args.identity_cache_ttl_days).refresh(engine)
+
+
+def add_upload_arguments(parser):
+    parser.add_argument('--bucket',
+        help = 'S3 bucket to save send lists',
+        default = 'plated-redshift-etl')
+    parser.add_argument('--s3dir',
+        help = 'S3 directory within bucket to save send lists',
+        default = 'manual/campaigns_jackie')
+    parser.add_argument('--n_parts', type = int, default = None,
+        help = 'number of files to stage for COPY, default one per slice')
+    parser.add_argument('--staging_format', choices = ['csv', 'parquet'],
+        default = 'csv',
+        help = 'file format of send lists staged in S3 for COPY')
+    parser.add_argument('--dry_run', action = 'store_true',
+        help = 'print the generated table DDL instead of uploading')
+    parser.add_argument('--incremental', action = 'store_true',
+        help = 'reload only targets whose send lists changed since the '
+               'last load')
+    parser.add_argument('--streaming', action = 'store_true',
+        help = 'stream send lists to S3 in chunks for lists too large '
+               'to fit in memory')
+    parser.add_argument('--chunksize', type = int, default = 500000,
+        help = 'rows read per chunk in streaming mode')
+    parser.add_argument('--work_dir', default = None,
+        help = 'directory for temporary partitions in streaming mode')
+    parser.add_argument('--parse_workers', type = int,
+        default = os.cpu_count(),
+        help = 'number of send lists parsed concurrently')
+    parser.add_argument('--cache_dir',
+        help = 'local directory caching parsed send lists',
+        default = str(Path(Path.home(), '.campaign_cache')))
+    parser.add_argument('--no_cache', action = 'store_true',
+        help = 're-parse every send list instead of using the cache')
+    parser.add_argument('--identity_cache', default = None,
+        help = 'sqlite file caching user ids for email/prospect/external ids')
+    parser.add_argument('--identity_cache_ttl_days', type = int, default = 7,
+        help = 'days before the identity cache is rebuilt from dw.users')
+    parser.add_argument('--cache_max_mb', type = int, default = 2048,
+        help = 'maximum size of the send list cache per campaign')
+    parser.add_argument('--cache_max_age_days', type = int, default = 90,
+        help = 'evict cached send lists unused for this many days')
+
+
 if __name__ == '__main__':
     parser = ArgumentParser('Upload campaign lists to Redshift.')
     parser.add_argument('--root_dir',
@@ -246,11 +965,9 @@ if __name__ == '__main__':
             'Reformatted Prioritized Campaign Lists')))
     parser.add_argument('campaign_dir',
         help = 'name of directory for desired campaign')
-    parser.add_argument('--bucket',
-        help = 'S3 bucket to save send lists',
-        default = 'plated-redshift-etl')
-    parser.add_argument('--s3dir',
-        help = 'S3 directory within bucket to save send lists',
-        default = 'manual/campaigns_jackie')
+    add_upload_arguments(parser)
     args = parser.parse_args()
+    if args.streaming and args.staging_format == 'parquet':
+        parser.error('--streaming stages send lists as csv and cannot be '
+                     'combined with --staging_format parquet')
     main(args)
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+from process_campaign.fetch import combine_chunks
+
+
+def test_combine_chunks_with_differently_typed_categories():
+    chunks = [pd.DataFrame({'segment_group': [np.nan, np.nan],
+                            'target_name': ['Test', 'Test'], 'n': [1, 2]}),
+              pd.DataFrame({'segment_group': ['a', None],
+                            'target_name': ['Control', 'Test'], 'n': [3, 4]}),
+              pd.DataFrame({'segment_group': [2, 1],
+                            'target_name': ['Test', 'Control'],
+                            'n': [5, 6]})]
+    data = combine_chunks(chunks, ['segment_group', 'target_name'])
+    assert data.segment_group.isnull().tolist() == [True, True, False, True,
+                                                    False, False]
+    assert list(data.segment_group.cat.categories) == ['1', '2', 'a']
+    assert list(data.target_name.cat.categories) == ['Control', 'Test']
+    assert data.n.dtype == np.int32
+    assert data.n.tolist() == [1, 2, 3, 4, 5, 6]
+
+
+def test_combine_chunks_without_chunks():
+    assert combine_chunks(iter([])).empty
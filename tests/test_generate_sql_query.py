@@ -0,0 +1,138 @@
+import re
+from argparse import Namespace
+import numpy as np
+import pandas as pd
+from process_campaign.generate_sql_query import (build_batch_query,
+    format_metric, required_metrics, widen_metrics)
+
+KPIS = ['cancelations', 'cancelation_rate', 'new_activations',
+        'activation_rate', 'reactivations', 'reactivation_rate',
+        'total_boxes_ordered', 'avg_boxes_ordered', 'gov', 'aov',
+        'desserts_ordered', 'dessert_take_rate', 'ordered_nth_box',
+        'redeemed_offer_discount', 'pct_redeemed', 'total_active_at_end',
+        'pct_active_at_end', 'total_upgrades', 'total_downgrades',
+        'ordered_ds', 'gift_cards_purchased', 'total_ordered_week_4',
+        'pct_ordered_week_4', 'avg_num_boxes_first_4_weeks',
+        'total_using_the_app', 'num_referrals_sent']
+
+
+def campaign(short_name, discount_name = None, **kpis):
+    info = pd.Series({'campaign_name': short_name.title(),
+        'campaign_short_name': short_name,
+        'responder_action': 'reactivated',
+        'start_date': pd.Timestamp('2017-12-20'),
+        'promo_period_end_date': pd.Timestamp('2018-01-03'),
+        'post_promo_period_end_date': pd.Timestamp('2018-01-17'),
+        'long_term_end_date': 'current_date'})
+    for kpi in KPIS:
+        info[kpi] = kpis.get(kpi, True)
+    info['ordered_nth_box'] = '2, 5'
+    info['ordered_ds'] = 1801.0
+    test_matrix = pd.DataFrame({'test_group': ['Test', 'Control'],
+        'segment_group': [None, None],
+        'offer_group': ['$10', 'none'],
+        'target_name': [short_name + '_test', short_name + '_control'],
+        'creative_template_name': ['c', None],
+        'population_name': ['p', 'p'],
+        'offer_campaign_name': [None, None],
+        'discount_name': [discount_name, None],
+        'message_offer': ['m', None]})
+    return info, test_matrix
+
+
+def arm_columns(query):
+    # output columns of each unioned arm of the campaign_lists CTE
+    arms = query.split('SELECT DISTINCT a.*')[1:]
+    columns = []
+    for arm in arms:
+        arm = arm.split('WHERE a.user_id')[0]
+        names = re.findall(r'SELECT c\.(\w+), c\.(\w+)', arm)[0]
+        names += tuple(re.findall(r'\bAS (\w+)\s*(?:,|\n)', arm))
+        columns.append(list(dict.fromkeys(names)))
+    return columns
+
+
+def test_batch_arms_share_columns_with_offer_kpi_off():
+    query = build_batch_query([
+        campaign('unskip_1801', discount_name = 'D10',
+                 redeemed_offer_discount = False),
+        campaign('unskip_1802', redeemed_offer_discount = False)])
+    first, second = arm_columns(query)
+    assert first == second
+    assert 'offer_redeemed' in first
+
+
+def test_batch_arms_cast_test_matrix_columns():
+    query = build_batch_query([campaign('unskip_1801'),
+                               campaign('unskip_1802')])
+    first, second = arm_columns(query)
+    assert first == second
+    for col in ['segment_group', 'offer_campaign_name', 'discount_name']:
+        assert query.count('CAST(tm.{0} AS VARCHAR(1024)) AS {0}'
+                           .format(col)) == 2
+
+
+def test_required_metrics_of_responder_expression():
+    info, _ = campaign('unskip_1801', **{kpi: False for kpi in KPIS})
+    info['ordered_nth_box'] = info['ordered_ds'] = None
+    info['responder_action'] = 'total_boxes_ordered >= 3 OR reactivated'
+    assert required_metrics(info) == ['subscription_changes', 'boxes_ordered']
+    info['responder_action'] = 'active_at_end'
+    assert required_metrics(info) == ['active_at_end']
+
+
+def test_format_metric():
+    values = pd.Series([0.1234, np.inf, np.nan, 2.0])
+    assert format_metric(values, 'percent').tolist() == \
+        ['12.34%', '', '', '200.00%']
+    assert format_metric(pd.Series([1234.5]), 'dollars').tolist() == \
+        ['$1,234.50']
+    assert format_metric(pd.Series([1234.5]), 'price').tolist() == \
+        ['$1234.50']
+    assert format_metric(pd.Series([1.23456]), 'average').tolist() == \
+        ['1.23']
+
+
+def test_widen_metrics():
+    data = pd.DataFrame({'target_name': ['A', 'A', 'B', 'B'],
+                         'promo_period': ['long_term', 'promo_period'] * 2,
+                         'n': [1, 2, 3, 4],
+                         'rate': ['10%', '20%', '30%', '40%']})
+    wide = widen_metrics(data, ['target_name'], ['n', 'rate'],
+                         ['promo_period', 'long_term', 'post_promo_period'])
+    assert list(wide.columns) == ['n\npromo_period', 'rate\npromo_period',
+        'n\nlong_term', 'rate\nlong_term', 'n\npost_promo_period',
+        'rate\npost_promo_period']
+    assert wide.loc['B'].tolist()[:4] == [4, '40%', 3, '30%']
+    assert wide['n\npost_promo_period'].isnull().all()
+
+
+def test_frozen_periods_reused_the_next_day(tmp_path, monkeypatch):
+    import process_campaign.generate_sql_query as g
+    info, test_matrix = campaign('unskip_1801')
+    queried = []
+
+    def fetch_cached_metrics(query, engine, args, campaigns, cache_name):
+        periods = re.findall(r"SELECT '(\w+)' AS promo_period", query)
+        queried.append(periods)
+        return pd.DataFrame({'promo_period': periods, 'n': 1}), {'v': 1}
+
+    monkeypatch.setattr(g, 'fetch_cached_metrics', fetch_cached_metrics)
+    monkeypatch.setattr(g, 'campaign_version', lambda engine, c: {'t': 1})
+    monkeypatch.setattr(g, 'load_watermark',
+                        lambda version: pd.Timestamp('2018-06-01'))
+    args = Namespace(no_frozen_periods = False, bucketed = False,
+                     from_rollup = False, freeze_after_days = 3,
+                     result_cache_dir = str(tmp_path))
+
+    for today in ['2018-06-01', '2018-06-02']:
+        monkeypatch.setattr(pd.Timestamp, 'now', classmethod(
+            lambda cls, tz = None: cls(today, tz = tz)))
+        query = g.build_query(info, test_matrix)
+        data, frozen = g.fetch_open_periods(query, None, args, info,
+                                            test_matrix, 'unskip_1801')
+    # promo_period stays queried since the responder flag is read from it
+    assert queried == [['promo_period', 'post_promo_period', 'long_term'],
+                       ['promo_period', 'long_term']]
+    assert sorted(frozen.promo_period) == ['post_promo_period',
+                                           'promo_period']
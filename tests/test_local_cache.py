@@ -0,0 +1,97 @@
+import os, time
+import pandas as pd
+from process_campaign.local_cache import LocalCache, SendListCache
+from process_campaign.result_cache import ResultCache
+
+
+class Unwritable:
+    def to_parquet(self, *args, **kwargs):
+        raise OSError('disk full')
+
+    to_pickle = to_parquet
+
+
+def test_send_list_key_follows_content(tmp_path):
+    cache = SendListCache(tmp_path.joinpath('cache'))
+    path = tmp_path.joinpath('list.csv')
+    path.write_text('user_id\n1\n')
+    key = cache.file_key(str(path))
+    assert cache.file_key(str(path)) == key
+
+    cache.store(str(path), pd.DataFrame({'user_id': [1]}),
+                encoding = 'cp1252')
+    os.utime(str(path), ns = (1, 1))
+    assert cache.file_key(str(path)) == key
+    assert cache.encoding(str(path)) == 'cp1252'
+
+    path.write_text('user_id\n2\n')
+    assert cache.file_key(str(path)) != key
+    assert cache.encoding(str(path)) is None
+    assert cache.load(str(path)) is None
+
+
+def test_send_list_cache_round_trip(tmp_path):
+    path = tmp_path.joinpath('list.csv')
+    path.write_text('user_id\n1\n')
+    cache = SendListCache(tmp_path.joinpath('cache'))
+    cache.store(str(path), pd.DataFrame({'user_id': [1]}))
+    cache.save()
+
+    reopened = SendListCache(tmp_path.joinpath('cache'))
+    assert reopened.load(str(path)).user_id.tolist() == [1]
+    assert (reopened.hits, reopened.misses) == (1, 0)
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = LocalCache(tmp_path)
+    for key in ['a', 'b', 'c']:
+        cache.put_frame(key, pd.DataFrame({'x': range(100)}))
+    entries = cache.manifest['entries']
+    for i, key in enumerate(['b', 'a', 'c']):
+        entries[key]['accessed'] = time.time() - 10 + i
+    cache.max_bytes = entries['a']['bytes'] + entries['c']['bytes']
+    cache.evict()
+    assert sorted(entries) == ['a', 'c']
+    assert not tmp_path.joinpath(
+        'b.{}'.format(entries['a']['format'])).exists()
+
+
+def test_evict_expired(tmp_path):
+    cache = LocalCache(tmp_path, max_age_days = 1)
+    cache.put_frame('old', pd.DataFrame({'x': [1]}))
+    cache.put_frame('new', pd.DataFrame({'x': [1]}))
+    cache.manifest['entries']['old']['accessed'] -= 2 * 86400
+    cache.evict()
+    assert list(cache.manifest['entries']) == ['new']
+
+
+def test_evict_file_records(tmp_path):
+    cache = SendListCache(tmp_path.joinpath('cache'))
+    kept, removed = tmp_path.joinpath('kept.csv'), tmp_path.joinpath('x.csv')
+    for path in (kept, removed):
+        path.write_text('user_id\n1\n')
+        cache.file_key(str(path))
+    removed.unlink()
+    cache.evict()
+    assert list(cache.manifest['files']) == [str(kept)]
+
+
+def test_failed_store_is_not_raised(tmp_path):
+    cache = LocalCache(tmp_path)
+    cache.put_frame('a', Unwritable())
+    assert cache.manifest['entries'] == {}
+    assert cache.get_frame('a') is None
+
+
+def test_result_cache_key(tmp_path):
+    cache = ResultCache(tmp_path)
+    version = {'dw.menu_order_boxes': [10, '2018-01-03']}
+    assert cache.key('SELECT 1', version) == cache.key('SELECT 1',
+        dict(version))
+    assert cache.key('SELECT 1', version) != cache.key('SELECT 2', version)
+    assert cache.key('SELECT 1', version) != cache.key('SELECT 1',
+        {'dw.menu_order_boxes': [11, '2018-01-03']})
+
+    cache.store('SELECT 1', version, pd.DataFrame({'x': [1]}))
+    assert cache.load('SELECT 1', version).x.tolist() == [1]
+    assert cache.load('SELECT 1', {}) is None
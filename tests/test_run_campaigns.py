@@ -0,0 +1,37 @@
+import contextvars, logging
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from process_campaign.run_campaigns import run_step
+
+
+def step_args(log_dir):
+    return Namespace(log_dir = str(log_dir), retries = 0, retry_delay = 0)
+
+
+def test_run_step_logs_nested_threads(tmp_path):
+    for subdir in ('output_logs', 'error_logs'):
+        Path(tmp_path, subdir).mkdir()
+    logging.getLogger().setLevel(logging.INFO)
+
+    def step_fn(args, engine):
+        with ThreadPoolExecutor(max_workers = 2) as executor:
+            executor.submit(contextvars.copy_context().run, logging.warning,
+                            'from a worker of {}'.format(args.campaign_dir)
+                            ).result()
+            executor.submit(logging.warning, 'outside the step').result()
+
+    assert run_step('upload', 'a', None, step_args(tmp_path), 'today',
+                    step_fn = step_fn)
+    output = Path(tmp_path, 'output_logs', 'upload_a_today.out').read_text()
+    assert 'from a worker of a' in output
+    assert 'outside the step' not in output
+
+
+def test_run_step_fails_without_log_dir(tmp_path):
+    def step_fn(args, engine):
+        raise AssertionError('step should not run')
+
+    assert not run_step('upload', 'a', None,
+                        step_args(Path(tmp_path, 'missing')), 'today',
+                        step_fn = step_fn)
@@ -0,0 +1,14 @@
+import pandas as pd
+from process_campaign.s3_read_write import S3ReadWrite
+
+
+def test_put_dataframe_streams_slices():
+    s3 = S3ReadWrite.__new__(S3ReadWrite)
+    s3.bucket, s3.folder = 'bucket', 'folder'
+    streamed = []
+    s3.stream_csv_to_S3 = lambda key, chunks: streamed.append(
+        (key, [len(chunk) for chunk in chunks]))
+    key = s3.put_dataframe_to_S3('lists', 'campaign',
+        pd.DataFrame({'user_id': range(5)}), chunksize = 2)
+    assert key == 'folder/lists/campaign.csv.gz'
+    assert streamed == [(key, [2, 2, 1])]
@@ -0,0 +1,31 @@
+from process_campaign.send_list_index import (build_prefix_index,
+    match_target, index_send_lists)
+
+
+def test_match_target_prefers_longest_name():
+    index = build_prefix_index(['Unskip_1801', 'Unskip_1801_Control'])
+    assert match_target('Unskip_1801_Control_1.csv', index) == \
+        'Unskip_1801_Control'
+    assert match_target('Unskip_1801_Test.csv', index) == 'Unskip_1801'
+
+
+def test_match_target_without_match():
+    index = build_prefix_index(['Unskip_1801'])
+    assert match_target('Unskip_18.csv', index) is None
+    assert match_target('Reactivate_1801.csv', index) is None
+
+
+def test_index_send_lists(tmp_path):
+    for name in ['Unskip_1801_Test.csv', 'Unskip_1801_Control.xlsx',
+                 'Other.csv', 'Unskip_1801_template.csv', '.hidden.csv',
+                 'notes.txt']:
+        tmp_path.joinpath(name).write_text('user_id\n1\n')
+    targets_by_file, unmatched, missing = index_send_lists(tmp_path,
+        ['Unskip_1801_Test', 'Unskip_1801_Control', 'Unskip_1801_Holdout',
+         float('nan')])
+    assert {path.split('/')[-1]: target
+            for path, target in targets_by_file.items()} == {
+        'Unskip_1801_Test.csv': 'Unskip_1801_Test',
+        'Unskip_1801_Control.xlsx': 'Unskip_1801_Control'}
+    assert [path.split('/')[-1] for path in unmatched] == ['Other.csv']
+    assert missing == ['Unskip_1801_Holdout']
@@ -0,0 +1,33 @@
+import codecs
+from process_campaign.text_encoding import detect_encoding
+
+TEXT = 'email,name\nzoë@example.com,Zoë\n'
+
+
+def write(tmp_path, data):
+    path = tmp_path.joinpath('list.csv')
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_byte_order_marks(tmp_path):
+    assert detect_encoding(write(tmp_path,
+        codecs.BOM_UTF8 + TEXT.encode('utf-8'))) == 'utf-8-sig'
+    assert detect_encoding(write(tmp_path,
+        TEXT.encode('utf-16'))) == 'utf-16'
+    assert detect_encoding(write(tmp_path,
+        TEXT.encode('utf-32'))) == 'utf-32'
+
+
+def test_utf8_and_cp1252(tmp_path):
+    assert detect_encoding(write(tmp_path, TEXT.encode('utf-8'))) == 'utf-8'
+    assert detect_encoding(write(tmp_path,
+        (TEXT + '’\n').encode('cp1252'))) == 'cp1252'
+    assert detect_encoding(write(tmp_path, b'name\n\x81\x8d\n')) == \
+        'iso-8859-1'
+
+
+def test_sample_ending_inside_character(tmp_path):
+    data = ('a' * 9 + 'ë' * 10).encode('utf-8')
+    assert detect_encoding(write(tmp_path, data), sample_size = 10) == \
+        'utf-8'
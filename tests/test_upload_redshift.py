@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+from process_campaign.local_cache import SendListCache
+from process_campaign.upload_redshift import (changed_targets,
+    compact_send_lists, redshift_column_type, stream_send_lists)
+
+COLUMNS = ['target_name', 'file_path', 'content_hash']
+
+
+def test_changed_targets():
+    ledger = pd.DataFrame([['A', 'a.csv', '1'], ['B', 'b.csv', '2'],
+                           ['C', 'c.csv', '3'], ['D', 'd.csv', '4']],
+                          columns = COLUMNS)
+    fingerprints = pd.DataFrame([['A', 'a.csv', '1'], ['B', 'b.csv', '9'],
+                                 ['D', 'd.csv', '4'], ['D', 'e.csv', '5'],
+                                 ['E', 'f.csv', '6']], columns = COLUMNS)
+    assert changed_targets(fingerprints, ledger) == ['B', 'C', 'D', 'E']
+    assert changed_targets(ledger, ledger) == []
+
+
+def test_redshift_column_type():
+    assert redshift_column_type(pd.Series([1, None], dtype = 'Int64')) == \
+        ('BIGINT', 'AZ64')
+    assert redshift_column_type(pd.Series([np.nan, np.nan])) == \
+        ('VARCHAR(256)', 'ZSTD')
+    assert redshift_column_type(pd.Series(['a' * 20, None])) == \
+        ('VARCHAR(32)', 'ZSTD')
+    assert redshift_column_type(pd.Series(['a@b.co'], name = 'email')) == \
+        ('VARCHAR(256)', 'ZSTD')
+    assert redshift_column_type(pd.Series(pd.Categorical(['A', 'B']))) == \
+        ('VARCHAR(16)', 'BYTEDICT')
+
+
+def test_compact_send_lists_reports_invalid_ids(caplog):
+    data = pd.DataFrame({'prospect_id': ['12', 'x7', None, '13'],
+                         'target_name': ['A', 'A', 'B', 'B']})
+    data = compact_send_lists(data, pd.Series(['A', 'B']))
+    assert data.prospect_id.tolist() == [12, pd.NA, pd.NA, 13]
+    assert "1 prospect_id values are not numeric" in caplog.text
+    assert "'x7'" in caplog.text
+
+
+def test_stream_send_lists_falls_back_to_latin1(tmp_path):
+    # a byte past the sampled prefix that is not valid utf-8
+    path = tmp_path.joinpath('Unskip_1801_Test.csv')
+    path.write_bytes(b'user_id,email\n' + b'1,a@b.co\n' * 2000 +
+                     b'2,zo\xeb@b.co\n')
+    cache = SendListCache(tmp_path.joinpath('cache'))
+    cache.file_key(str(path))
+    cache.manifest['files'][str(path)]['encoding'] = 'utf-8'
+    test_matrix = pd.DataFrame({'target_name': ['Unskip_1801_Test']})
+    info = pd.Series({'campaign_name': 'Unskip 1801',
+                      'campaign_short_name': 'unskip_1801'})
+    _, schema, _ = stream_send_lists(tmp_path, test_matrix, 'bucket', 'dir',
+        info, chunksize = 500, upload = False, cache = cache,
+        targets_by_file = {str(path): 'Unskip_1801_Test'})
+    assert list(schema.columns) == ['user_id', 'email', 'target_name']